@@ -0,0 +1,256 @@
+"""
+Benchmarks of the tessellation, Markov chain and shuffle hot paths.
+
+Every benchmark is timed over a matrix of grid sizes and seed counts, taking the
+best of several repeats, and its peak traced memory is measured in a separate
+run so tracemalloc does not slow down the timing.
+
+    python benchmarks/run.py                  # run and print the results
+    python benchmarks/run.py --save           # store the results as the baseline
+    python benchmarks/run.py --compare        # exit with 1 on regressions against the baseline
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+
+import subsurface
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'baseline.json')
+
+grids = [32,64,128]
+seed_counts = [100,1000]
+
+
+def random_voronoi(voxels,n_seeds,rng,clusters=None):
+
+    return subsurface.Voronoi([voxels]*3,[1.0]*3,rng.random((n_seeds,3)),
+                              clusters=None if clusters is None else rng.random((clusters,3)))
+
+def random_orientations(n,rng):
+
+    quaternions = rng.normal(size=(n,4))
+    quaternions *= np.sign(quaternions[:,:1])/np.linalg.norm(quaternions,axis=1,keepdims=True)
+
+    return quaternions
+
+
+# Every benchmark takes a grid size, seed count and generator and returns the
+# function to time and the amount of work it does, so rates can be reported
+def generate_coordinates(voxels,n_seeds,rng):
+
+    voronoi = random_voronoi(voxels,n_seeds,rng)
+
+    return lambda: voronoi.generate_coordinates().coordinates, voxels**3
+
+def generate_matrix(voxels,n_seeds,rng):
+
+    voronoi = random_voronoi(voxels,n_seeds,rng)
+
+    return voronoi.generate_matrix, voxels**3
+
+def generate_clusters(voxels,n_seeds,rng):
+
+    voronoi = random_voronoi(voxels,n_seeds,rng,clusters=max(n_seeds//10,1))
+    seed_matrix = voronoi.matrix
+
+    def run():
+        # Cluster the seed grid again rather than the cached result
+        voronoi.matrix = seed_matrix
+        return voronoi.generate_clusters()
+
+    return run, voxels**3
+
+def grain_centre(voxels,n_seeds,rng):
+
+    voronoi = random_voronoi(voxels,n_seeds,rng)
+    matrix = voronoi.matrix
+
+    def run():
+        # Setting the matrix drops the cached grain statistics
+        voronoi.matrix = matrix
+        return voronoi.grain_centre
+
+    return run, n_seeds
+
+def markov_chain(voxels,n_seeds,rng,iterations=20):
+
+    # The chain updates its proposals from the margin of the reference
+    voronoi = random_voronoi(voxels,n_seeds,rng)
+    voronoi.generate_matrix(margin=True)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            subsurface.MarkovChain(voronoi,iterations,0.9,0.1/voxels,rng=np.random.default_rng(0))
+
+    return run, iterations
+
+def shuffle(voxels,n_seeds,rng,iterations=5000,batch=1):
+
+    voronoi = random_voronoi(voxels,n_seeds,rng)
+    matrix = voronoi.matrix
+    orientations = random_orientations(n_seeds,rng)
+
+    def run():
+        subsurface.Shuffle(matrix,orientations,iterations,minimize=True,output_frequency=iterations,
+                           rng=np.random.default_rng(0),batch=batch)
+
+    return run, iterations
+
+def shuffle_batched(voxels,n_seeds,rng):
+
+    return shuffle(voxels,n_seeds,rng,iterations=50000,batch=256)
+
+def find_neighbour_grains(voxels,n_seeds,rng):
+
+    matrix = random_voronoi(voxels,n_seeds,rng).matrix
+
+    return lambda: subsurface.find_neighbour_grains(matrix,return_counts=True), voxels**3
+
+def find_grain_boundary(voxels,n_seeds,rng):
+
+    matrix = random_voronoi(voxels,n_seeds,rng).matrix
+
+    return lambda: subsurface.find_grain_boundary(matrix,output='index'), voxels**3
+
+benchmarks = [generate_coordinates,
+              generate_matrix,
+              generate_clusters,
+              grain_centre,
+              markov_chain,
+              shuffle,
+              shuffle_batched,
+              find_neighbour_grains,
+              find_grain_boundary,
+              ]
+
+
+def measure(function,repeat):
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times),peak
+
+def machine():
+
+    return dict(platform=platform.platform(),
+                processor=platform.processor(),
+                cpu_count=os.cpu_count(),
+                python=platform.python_version(),
+                numpy=np.__version__)
+
+def run(names,grids,seed_counts,repeat):
+
+    results = {}
+
+    for benchmark in benchmarks:
+
+        if names and benchmark.__name__ not in names:
+            continue
+
+        for voxels in grids:
+            for n_seeds in seed_counts:
+
+                key = f'{benchmark.__name__}/{voxels}^3/{n_seeds}'
+
+                function,work = benchmark(voxels,n_seeds,np.random.default_rng(0))
+                seconds,peak = measure(function,repeat)
+
+                results[key] = dict(time=seconds,peak=peak,rate=work/seconds)
+
+                print(f'{key:<42}{seconds:>10.4f} s{peak/2**20:>10.1f} MiB{work/seconds:>14.4g} /s',flush=True)
+
+    return results
+
+def compare(results,baseline,tolerance):
+
+    regressions = []
+
+    print(f'\n{"benchmark":<42}{"time":>10}{"peak":>10}')
+
+    for key,result in results.items():
+
+        if key not in baseline:
+            continue
+
+        time_ratio = result['time']/baseline[key]['time']
+        peak_ratio = result['peak']/max(baseline[key]['peak'],1)
+
+        flag = ''
+        if time_ratio > 1+tolerance or peak_ratio > 1+tolerance:
+            flag = '  REGRESSION'
+            regressions.append(key)
+
+        print(f'{key:<42}{time_ratio:>9.2f}x{peak_ratio:>9.2f}x{flag}')
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names',nargs='*',help='benchmarks to run, defaults to all')
+    parser.add_argument('--grids',type=int,nargs='+',default=grids,help='voxels along each edge')
+    parser.add_argument('--seeds',type=int,nargs='+',default=seed_counts,help='numbers of seeds')
+    parser.add_argument('--repeat',type=int,default=3,help='timed repeats, the best is kept')
+    parser.add_argument('--baseline',default=baseline_file,help='baseline file')
+    parser.add_argument('--save',action='store_true',help='store the results as the baseline')
+    parser.add_argument('--compare',action='store_true',help='compare the results with the baseline')
+    parser.add_argument('--tolerance',type=float,default=0.25,help='allowed slow down or memory growth as a fraction')
+    arguments = parser.parse_args(argv)
+
+    results = run(arguments.names,arguments.grids,arguments.seeds,arguments.repeat)
+
+    if arguments.compare:
+
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+
+        if baseline['machine'] != machine():
+            print('\nThe baseline was recorded on a different machine:',baseline['machine'])
+
+        regressions = compare(results,baseline['results'],arguments.tolerance)
+
+        if regressions:
+            print(f'\n{len(regressions)} regressions')
+            return 1
+
+    if arguments.save:
+
+        # Results of benchmarks that were not run are kept
+        baseline = dict(results={})
+
+        if os.path.exists(arguments.baseline):
+            with open(arguments.baseline) as file:
+                baseline = json.load(file)
+
+        baseline['machine'] = machine()
+        baseline['results'].update(results)
+
+        with open(arguments.baseline,'w') as file:
+            json.dump(baseline,file,indent=2,sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
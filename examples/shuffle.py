@@ -1,4 +1,5 @@
 from subsurface.imports import *
+import damask
 
 from subsurface.tools import plot_images,extract_surfaces
 from subsurface import Voronoi
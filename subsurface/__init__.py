@@ -14,5 +14,16 @@ from .plotting import *
 
 # Class Files
 from ._voronoi import Voronoi
-from ._markovchain import MarkovChain
-from ._shuffle import Shuffle
+from ._markovchain import MarkovChain, iter_markov_chain, run_chains, resume_markov_chain
+from ._shuffle import Shuffle, TemperedShuffle, SwapLog, resume_shuffle
+from .ensemble import Ensemble
+from .write import to_csv
+from .vti import write_vti
+
+# matplotlib and damask are only imported when they are first used
+def __getattr__(name):
+
+    if name in ['plt','damask']:
+        return getattr(imports,name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,6 +1,11 @@
 import subsurface
 from subsurface.imports import *
 from subsurface.tools import *
+from subsurface.parallel import share_array, attach_array, release
+from subsurface.monitor import Monitor
+from subsurface.checkpoint import Checkpoint, load_checkpoint, get_rng_state, restore_rng
+import multiprocessing
+import collections
 
 
 def MarkovChain(voronoi_reference: subsurface.Voronoi,
@@ -18,7 +23,14 @@ def MarkovChain(voronoi_reference: subsurface.Voronoi,
                 weights: np.ndarray | None = None,
                 alpha_scale: float = 1.0,
                 chanced: bool = False,
-                max_step: float = 1.0
+                max_step: float = 1.0,
+                surface_only: bool = False,
+                rng: np.random.Generator | None = None,
+                callback=None,
+                report_frequency: int = 100,
+                progress_interval: float | None = 1.0,
+                checkpoint: str | None = None,
+                checkpoint_interval: float = 300.0,
                 ):
     """
     Function to generate a list of perturbed Voronoi objects.
@@ -38,46 +50,371 @@ def MarkovChain(voronoi_reference: subsurface.Voronoi,
     bounded: bool
         Whether to restrict the seeds to stay within the size of the box.
         Defaults to false.
+    surface_only: bool
+        Score proposals by tessellating only the compared layer. The full matrix
+        of an accepted Voronoi object is generated when it is first accessed.
+        Defaults to false.
+    rng: np.random.Generator | None
+        Random number generator for the perturbations and acceptance chance.
+        Defaults to the global numpy state.
+    callback: callable | None
+        Function called every report_frequency iterations with a dictionary of metrics:
+        the cumulative seconds spent to perturb, tessellate, score and accept under
+        timings, the success rate, the perturbation, the accuracy and the displacement.
+        See subsurface.monitor.Monitor.
+    report_frequency: int
+        Number of iterations between calls of the callback.
+    progress_interval: float | None
+        Wall time in seconds between progress lines, None to run silently.
+    checkpoint: str | None
+        HDF5 file to write the state of the chain to, see resume_markov_chain. The
+        emitted outputs are appended to checkpoint + '.history'.
+    checkpoint_interval: float
+        Wall time in seconds between checkpoints. The last iteration is always saved.
     Returns
     -------
     successful_voronoi : list
         List of perturbed Voronoi objects.
     
+    See iter_markov_chain for a generator that does not hold the Voronoi objects in memory.
+    """
+
+    parameters = dict(N_iter=N_iter,
+                      accuracy_threshold=accuracy_threshold,
+                      perturbation=perturbation,
+                      output_frequency=output_frequency,
+                      target_rate=target_rate,
+                      window_size=window_size,
+                      dampening_factor=dampening_factor,
+                      return_scale=return_scale,
+                      return_rate=return_rate,
+                      bounded=bounded,
+                      layer=layer,
+                      weights=weights,
+                      alpha_scale=alpha_scale,
+                      chanced=chanced,
+                      max_step=max_step,
+                      surface_only=surface_only)
+
+    checkpointer = None if checkpoint is None else Checkpoint(checkpoint,checkpoint_interval)
+
+    return _markov_chain(voronoi_reference,parameters,rng,{},dict(voronoi=[],perturbation=[],rate=[],increment=[]),
+                         Monitor(N_iter,callback,report_frequency,progress_interval),checkpointer)
+
+
+def resume_markov_chain(filename: str,
+                        checkpoint_interval: float = 300.0,
+                        callback=None,
+                        report_frequency: int = 100,
+                        progress_interval: float | None = 1.0,
+                        ):
+    """
+    Function to continue a MarkovChain from its last checkpoint.
+
+    The chain continues exactly as it would have without the interruption and
+    keeps writing checkpoints to the same file.
+
+    Parameters
+    ----------
+    filename : str
+        Checkpoint file written by MarkovChain.
+    checkpoint_interval : float
+        Wall time in seconds between checkpoints.
+    callback, report_frequency, progress_interval
+        See MarkovChain.
+
+    Returns
+    -------
+    The outputs of MarkovChain, including the Voronoi objects emitted before the
+    checkpoint, which generate their matrix when it is first accessed.
+    """
+
+    arrays,attributes = load_checkpoint(filename)
+
+    if attributes['kind'] != 'MarkovChain':
+        raise ValueError(f"{filename} is a checkpoint of {attributes['kind']}, not MarkovChain")
+
+    parameters = attributes['parameters']
+    parameters['weights'] = arrays.get('parameters/weights')
+
+    reference = attributes['reference']
+
+    levels = [arrays[f'reference/clusters/{level}'] for level in range(reference.pop('levels'))]
+    kind = reference.pop('clusters')
+
+    if kind == 'list':
+        clusters = levels
+    elif kind == 'array':
+        clusters = levels[0]
+    else:
+        clusters = None
+
+    voronoi_reference = subsurface.Voronoi(seeds=arrays['reference/seeds'],clusters=clusters,**reference)
+
+    state = dict(attributes['chain'],
+                 seeds=arrays['chain/seeds'],
+                 success=arrays['chain/success'].tolist(),
+                 reference_layer=arrays['reference/layer'])
+
+    # Emitted Voronoi objects generate their matrix on first access
+    successful_voronoi = []
+
+    for seeds in arrays['outputs/seeds']:
+        voronoi = copy.copy(voronoi_reference)
+        voronoi.seeds = seeds
+        successful_voronoi.append(voronoi)
+
+    outputs = dict(voronoi=successful_voronoi,
+                   perturbation=arrays['outputs/perturbation'].tolist(),
+                   rate=arrays['outputs/rate'].tolist(),
+                   increment=arrays['outputs/increment'].tolist())
+
+    rng = restore_rng(attributes['rng']['state'],attributes['rng']['generator'])
+
+    return _markov_chain(voronoi_reference,parameters,rng,state,outputs,
+                         Monitor(parameters['N_iter'],callback,report_frequency,progress_interval),
+                         Checkpoint(filename,checkpoint_interval,resume=True))
+
+
+# Parameters of MarkovChain taken by _markov_chain_steps, in order
+_step_parameters = ['N_iter','accuracy_threshold','perturbation','target_rate','window_size','dampening_factor',
+                    'bounded','layer','weights','alpha_scale','chanced','max_step','surface_only']
+
+def _markov_chain(voronoi_reference,parameters,rng,state,outputs,monitor,checkpointer):
+
+    output_frequency = parameters['output_frequency']
+
+    for N,voronoi,step,success_rate in _markov_chain_steps(voronoi_reference,*[parameters[name] for name in _step_parameters],
+                                                           rng,monitor,state):
+
+        outputs['perturbation'].append(step)
+        outputs['rate'].append(success_rate)
+
+        if voronoi is not None:
+
+            # Only keep every output_frequency accepted Voronoi object
+            if len(outputs['increment']) % output_frequency == 0:
+                outputs['voronoi'].append(voronoi)
+
+            outputs['increment'].append(N)
+
+        # The last iteration is always saved so a finished chain can be resumed to its outputs
+        if checkpointer is not None and (checkpointer.due() or N+1 == parameters['N_iter']):
+            _save_markov_chain(checkpointer,voronoi_reference,parameters,rng,state,outputs)
+
+    successful_voronoi = outputs['voronoi']
+    perturbation_list = outputs['perturbation']
+    rate_list = outputs['rate']
+    increment_value = outputs['increment']
+
+    if parameters['return_scale']==True:
+
+        if parameters['return_rate']==True:
+
+            return successful_voronoi, perturbation_list[::output_frequency], rate_list[::output_frequency],increment_value
+    
+        elif parameters['return_rate']==False:
+
+            return successful_voronoi, perturbation_list[::output_frequency],increment_value
+        
+    elif parameters['return_scale']==False:
+
+        if parameters['return_rate']==True:
+
+            return successful_voronoi, rate_list[::output_frequency],increment_value
+        
+        elif parameters['return_rate']==False:
+            
+            return successful_voronoi,increment_value
+    
+    else:
+        return successful_voronoi, increment_value
+
+def _save_markov_chain(checkpointer,voronoi_reference,parameters,rng,state,outputs):
+
+    clusters = voronoi_reference.clusters
+
+    if isinstance(clusters,list):
+        kind,levels = 'list',clusters
+    elif clusters.dtype == object:
+        kind,levels = None,[]
+    else:
+        kind,levels = 'array',[clusters]
+
+    seeds = voronoi_reference.seeds
+
+    constant = {'reference/seeds':seeds,
+                'reference/layer':state['reference_layer']}
+
+    for level,points in enumerate(levels):
+        constant[f'reference/clusters/{level}'] = points
+
+    if parameters['weights'] is not None:
+        constant['parameters/weights'] = parameters['weights']
+
+    arrays = {'chain/seeds':state['seeds'],
+              'chain/success':np.array(state['success'],dtype=np.int8)}
+
+    # Only the outputs emitted since the last checkpoint are written
+    new = lambda name,rows: rows[checkpointer.written(name):]
+
+    append = {'outputs/seeds':np.array([voronoi.seeds for voronoi in new('outputs/seeds',outputs['voronoi'])]).reshape((-1,)+seeds.shape),
+              'outputs/perturbation':np.array(new('outputs/perturbation',outputs['perturbation']),dtype=float),
+              'outputs/rate':np.array(new('outputs/rate',outputs['rate']),dtype=float),
+              'outputs/increment':np.array(new('outputs/increment',outputs['increment']),dtype=np.int64)}
+
+    attributes = dict(kind='MarkovChain',
+                      parameters={name:value for name,value in parameters.items() if name != 'weights'},
+                      reference=dict(voxels=voronoi_reference.voxels,
+                                     size=voronoi_reference.size,
+                                     origin=voronoi_reference.origin,
+                                     periodic=voronoi_reference.periodic,
+                                     minkowski=voronoi_reference.minkowski,
+                                     clusters=kind,
+                                     levels=len(levels)),
+                      chain={name:state[name] for name in ['N','perturbation','total_displacement']},
+                      rng=dict(generator=rng is not None,state=get_rng_state(rng)))
+
+    checkpointer.save(arrays,attributes,constant,append)
+
+
+def iter_markov_chain(voronoi_reference: subsurface.Voronoi,
+                      N_iter: int,
+                      accuracy_threshold: float,
+                      perturbation: float,
+                      output_frequency: int = 1,
+                      target_rate: float | None = None,
+                      window_size: int = 1000,
+                      dampening_factor: float = 0.001,
+                      bounded: bool = False,
+                      layer: int = 0,
+                      weights: np.ndarray | None = None,
+                      alpha_scale: float = 1.0,
+                      chanced: bool = False,
+                      max_step: float = 1.0,
+                      surface_only: bool = False,
+                      rng: np.random.Generator | None = None,
+                      callback=None,
+                      report_frequency: int = 100,
+                      progress_interval: float | None = 1.0,
+                      ):
+    """
+    Generator that yields perturbed Voronoi objects as the chain accepts them.
+
+    Takes the same parameters as MarkovChain. Accepted Voronoi objects that are not
+    emitted are dropped as soon as the chain moves on, so only the current state
+    of the chain and the proposal are held in memory.
+
+    Yields
+    ------
+    increment : int
+        Iteration at which the Voronoi object was accepted.
+    voronoi : Voronoi Object
+        Every output_frequency accepted Voronoi object.
+    """
+
+    accepted = 0
+
+    monitor = Monitor(N_iter,callback,report_frequency,progress_interval)
+
+    for N,voronoi,_,_ in _markov_chain_steps(voronoi_reference,N_iter,accuracy_threshold,perturbation,
+                                             target_rate,window_size,dampening_factor,bounded,layer,
+                                             weights,alpha_scale,chanced,max_step,surface_only,rng,
+                                             monitor,{}):
+
+        if voronoi is None:
+            continue
+
+        if accepted % output_frequency == 0:
+            yield N,voronoi
+
+        accepted += 1
+
+
+def _markov_chain_steps(voronoi_reference,N_iter,accuracy_threshold,perturbation,
+                        target_rate,window_size,dampening_factor,bounded,layer,
+                        weights,alpha_scale,chanced,max_step,surface_only,rng,monitor,state):
+    """
+    Run the chain and yield (iteration, accepted Voronoi or None, perturbation, success rate) for every iteration.
+
+    The state of the chain is kept up to date in the dictionary state after every
+    iteration, and a chain given the state of an earlier one continues from it.
     """
 
     # Copy the input voronoi to become an instance for the chain
     voronoi_chain = copy.copy(voronoi_reference)
 
-    # Create a list to hold successful Voronoi
-    successful_voronoi=[]
-    success_list = []
-    perturbation_list = []
-    rate_list = []
-    increment_value = []
+    if 'seeds' in state:
+        voronoi_chain.seeds = state['seeds']
+        voronoi_chain.matrix = None
+
+    # Only the most recent outcomes enter the success rate
+    success_list = collections.deque(state.get('success',[]),maxlen=window_size-1 if window_size > 1 else None)
+
+    total_displacement = state.get('total_displacement',1e-10)
+    perturbation = state.get('perturbation',perturbation)
+
+    if 'reference_layer' not in state:
+        state['reference_layer'] = voronoi_reference.matrix[:,:,layer]
 
-    total_displacement = 1e-10
+    reference_layer = state['reference_layer']
+
+    # Proposals are updated from a base grid with a margin at earlier chain seeds. The base
+    # is generated again at the chain head once the voxels queried beyond those of the first
+    # update from it, which grow as the chain drifts away, cost as much as generating it,
+    # about one and a half grids of queries.
+    voronoi_base = None
 
     # Perform N_iter loops
-    for N in range(N_iter):
+    for N in range(state.get('N',0),N_iter):
+
+        step = perturbation
 
-        perturbation_list.append(perturbation)
+        monitor.stage('perturb')
         
         # Create a perturbed copy
         voronoi_perturbed = copy.copy(voronoi_chain)
-        voronoi_perturbed.perturb_seed_locations(perturbation,bounded,weights)
-        voronoi_perturbed.generate_matrix()
-    
+        voronoi_perturbed.perturb_seed_locations(perturbation,bounded,weights,rng)
+
+        monitor.stage('tessellate')
+
         # Determine the surface accuracy
-        accuracy = calculate_accuracy(voronoi_reference.matrix,voronoi_perturbed.matrix,layer=layer)
+        if surface_only:
+            voronoi_perturbed.matrix = None
+            perturbed_layer = voronoi_perturbed.generate_layer(layer)
+
+        else:
+            if voronoi_base is None:
+                voronoi_base = voronoi_chain
+
+                if voronoi_base.margin is None:
+                    voronoi_base = copy.copy(voronoi_chain).generate_matrix(margin=True)
+
+                first_update,excess = None,0
+
+            voronoi_perturbed.matrix = voronoi_base.matrix
+            voronoi_perturbed.margin = voronoi_base.margin
+            voronoi_perturbed.update_matrix(voronoi_base.seeds,voronoi_perturbed.seeds)
+
+            first_update = voronoi_perturbed.updated_voxels if first_update is None else first_update
+            excess += voronoi_perturbed.updated_voxels - first_update
+
+            perturbed_layer = voronoi_perturbed.matrix[:,:,layer]
+
+        monitor.stage('score')
+
+        accuracy = calculate_accuracy(reference_layer,perturbed_layer)
     
         current_displacement = np.mean(np.linalg.norm(voronoi_reference.seeds-voronoi_perturbed.seeds,axis=1))
 
         alpha = alpha_scale*(current_displacement / total_displacement)
 
         if chanced:
-            chance = np.random.random(size=1)
+            chance = (np.random if rng is None else rng).random(size=1)
         else:
             chance = 1.0
+
+        monitor.stage('accept')
         
         # If we reconstruct the surface within some error, save the seeds and make them the new chain seed
         # We can also check for harsh accuracy. 
@@ -85,28 +422,21 @@ def MarkovChain(voronoi_reference: subsurface.Voronoi,
         if (alpha > chance) and (accuracy >= accuracy_threshold):
             # update the current best displacement
             total_displacement = current_displacement
-                    
-            successful_voronoi.append(voronoi_perturbed)
 
             voronoi_chain = voronoi_perturbed
 
+            if voronoi_base is not None and excess >= 1.5*voronoi_chain.matrix.size:
+                voronoi_base = None
+
             success_list.append(1)
-            increment_value.append(N)
+            accepted = voronoi_perturbed
             
         else:
             success_list.append(0)
-
+            accepted = None
 
         # Find the success rate over the last 1000 perturbations
-        success_rate = np.sum(success_list[-1*window_size+1:])/window_size
-
-        rate_list.append(success_rate)
-
-        # Print statements and adapative perturbation
-        # Print statement
-        statement = 'Searching...{N}/{N_max}'.format(N=N,N_max=N_iter) + 'Success Rate..{X}'.format(X=np.round(success_rate,3)).rjust(20,'.') + '..' +str(np.round(perturbation*1e6,3))
-
-        print(statement, end='\r')
+        success_rate = np.sum(success_list)/window_size
 
         # If a target rate has been specified then change the perturbation to achieve it
         if not target_rate is None:
@@ -126,25 +456,158 @@ def MarkovChain(voronoi_reference: subsurface.Voronoi,
                     # Adjust the perturbation
                     perturbation = min(max_step,perturbation*scale_factor)
 
-    if return_scale==True:
+        monitor.update(N,acceptance_rate=success_rate,step=step,accuracy=accuracy,displacement=total_displacement)
 
-        if return_rate==True:
+        state.update(N=N+1,seeds=voronoi_chain.seeds,success=success_list,
+                     total_displacement=total_displacement,perturbation=perturbation)
 
-            return successful_voronoi[::output_frequency], perturbation_list[::output_frequency], rate_list[::output_frequency],increment_value
-    
-        elif return_rate==False:
+        yield N,accepted,step,success_rate
 
-            return successful_voronoi[::output_frequency], perturbation_list[::output_frequency],increment_value
-        
-    elif return_scale==False:
 
-        if return_rate==True:
+def run_chains(voronoi_reference: subsurface.Voronoi,
+               n_chains: int,
+               N_iter: int,
+               accuracy_threshold: float,
+               perturbation: float,
+               output_frequency: int = 1,
+               processes: int | None = None,
+               seed: int | None = None,
+               progress_interval: float | None = None,
+               **kwargs,
+               ):
+    """
+    Function to run independent Markov chains from the same reference over a process pool.
 
-            return successful_voronoi[::output_frequency], rate_list[::output_frequency],increment_value
-        
-        elif return_rate==False:
-            
-            return successful_voronoi[::output_frequency],increment_value
-    
-    else:
-        return successful_voronoi[::output_frequency], increment_value
\ No newline at end of file
+    The reference matrix and margin are placed in shared memory once
+    and every worker reads them in place. A reference without a grid is
+    tessellated once on a copy together with its margin, so the reference is
+    never modified. A grid without a margin, such as a clustered one, is
+    shared alone and every chain generates its own margin. Each chain draws
+    from its own np.random.Generator spawned from a common SeedSequence.
+
+    Parameters
+    ----------
+    voronoi_reference : Voronoi Object
+        A specific Voronoi class object to be perturbed.
+    n_chains : int
+        Number of independent chains to run.
+    N_iter : int
+        Number of iterations to run each markov chain for.
+    accuracy_threshold : float
+        Fraction of the surface that must be kept constant during permutation.
+    perturbation : float
+        Perturbation length scale in [m].
+    output_frequency : int
+        Frequency to save the perturbed Voronoi objects.
+    processes : int | None
+        Number of worker processes. Defaults to the number of cores.
+    seed : int | None
+        Entropy for the SeedSequence the chain generators are spawned from.
+    progress_interval : float | None
+        Wall time in seconds between progress lines counting the finished chains,
+        None to run silently. The chains themselves run silently.
+    **kwargs
+        Further keyword arguments passed to MarkovChain. A checkpoint is written
+        per chain, with the chain index appended to the file name, for example
+        chain-0.h5 for checkpoint='chain.h5'.
+
+    Returns
+    -------
+    successful_voronoi : list
+        List of perturbed Voronoi objects of all chains, ordered by chain.
+    chain_index : list
+        Index of the chain that produced each Voronoi object.
+    increment_value : list
+        Iteration of its chain at which each Voronoi object was accepted.
+    """
+
+    # The reference is left as it was passed in, its grid and margin are made on a copy
+    voronoi_copy = copy.copy(voronoi_reference)
+
+    if voronoi_copy._matrix is None:
+        voronoi_copy.generate_matrix(margin=True)
+
+    shared = [('matrix',voronoi_copy.matrix)]
+
+    if voronoi_copy.margin is not None:
+        shared.append(('margin',voronoi_copy.margin))
+
+    blocks = []
+    descriptors = {}
+
+    try:
+        for name,array in shared:
+            block,descriptors[name] = share_array(array)
+            blocks.append(block)
+
+        reference = dict(voxels=voronoi_reference.voxels,
+                         size=voronoi_reference.size,
+                         seeds=voronoi_reference.seeds,
+                         clusters=voronoi_reference.clusters,
+                         periodic=voronoi_reference.periodic,
+                         origin=voronoi_reference.origin,
+                         minkowski=voronoi_reference.minkowski)
+
+        streams = np.random.SeedSequence(seed).spawn(n_chains)
+
+        tasks = [(index,stream,N_iter,accuracy_threshold,perturbation,output_frequency,kwargs) for index,stream in enumerate(streams)]
+
+        results = [None]*n_chains
+        monitor = Monitor(n_chains,interval=progress_interval,label='Chains')
+
+        with multiprocessing.Pool(processes,initializer=_initialise_chain_worker,initargs=(reference,descriptors)) as pool:
+
+            # Progress is only reported here, the workers would write over each other
+            for finished,(index,result) in enumerate(pool.imap_unordered(_run_chain_worker,tasks)):
+                results[index] = result
+                monitor.update(finished)
+
+    finally:
+        release(blocks)
+
+    successful_voronoi = []
+    chain_index = []
+    increment_value = []
+
+    for index,(chain_voronoi,chain_increment) in enumerate(results):
+
+        successful_voronoi.extend(chain_voronoi)
+        chain_index.extend([index]*len(chain_voronoi))
+        increment_value.extend(chain_increment[::output_frequency])
+
+    return successful_voronoi, chain_index, increment_value
+
+
+# Reference Voronoi object and the shared memory it views, one per worker process
+_worker_reference = None
+_worker_blocks = []
+
+def _initialise_chain_worker(reference,descriptors):
+
+    global _worker_reference
+
+    _worker_reference = subsurface.Voronoi(**reference)
+
+    for name,descriptor in descriptors.items():
+        block,array = attach_array(descriptor)
+        _worker_blocks.append(block)
+
+        setattr(_worker_reference,name,array)
+
+def _run_chain_worker(task):
+
+    index,stream,N_iter,accuracy_threshold,perturbation,output_frequency,kwargs = task
+
+    kwargs = dict(kwargs,progress_interval=None)
+
+    # Every chain writes its own checkpoint
+    if kwargs.get('checkpoint') is not None:
+        root,extension = os.path.splitext(kwargs['checkpoint'])
+        kwargs['checkpoint'] = f'{root}-{index}{extension}'
+
+    successful_voronoi,increment_value = MarkovChain(_worker_reference,N_iter,accuracy_threshold,perturbation,
+                                                     output_frequency=output_frequency,
+                                                     rng=np.random.default_rng(stream),
+                                                     **kwargs)
+
+    return index,(successful_voronoi,increment_value)
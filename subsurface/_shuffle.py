@@ -1,9 +1,13 @@
 from subsurface.imports import *
 from subsurface.tools import *
-import random
+from subsurface.construction import get_label_dtype
+from subsurface.misorientation import symmetry_operators, disorientation_angle, DisorientationTable, lattice_families, maximum_disorientation
+from subsurface.parallel import share_array, attach_array, release
+from subsurface.monitor import Monitor
+from subsurface.checkpoint import Checkpoint, load_checkpoint, get_rng_state, restore_rng
 import multiprocessing 
 
-def Shuffle(material,orientation,iterations,exclude=None,return_full=False,minimize=False,family='cubic',lattice='cI',output_frequency=1):
+def Shuffle(material,orientation,iterations,exclude=None,return_full=False,minimize=False,family='cubic',lattice='cI',output_frequency=1,rng=None,batch=1,output='orientations',keyframe_frequency=10000,target=None,bins=None,weighted=False,callback=None,report_frequency=1000,progress_interval=None,checkpoint=None,checkpoint_interval=300.0):
     """
     Function to shuffle the orientations in a representative volume element.
 
@@ -25,297 +29,1119 @@ def Shuffle(material,orientation,iterations,exclude=None,return_full=False,minim
         Slip family to consider - see damask.Orientation for full description.
     lattice : str
         Lattice to consider - see damask.Orientation for full description.
+    output_frequency : int
+        Frequency to save the shuffled orientations.
+    rng : np.random.Generator or None
+        Random number generator to draw the swaps from. Defaults to the global numpy state.
+    batch : int
+        Number of candidate swaps drawn per step. Above 1, the candidates that do not
+        touch a neighbour of an earlier candidate are evaluated together in one pass,
+        each counting as one iteration. Defaults to one swap per iteration.
+    output : str
+        'orientations' to save the orientations every output_frequency increment, or
+        'log' to record every accepted swap in a SwapLog.
+    keyframe_frequency : int
+        Number of iterations between the arrangements stored by a SwapLog.
+    target : array or None
+        Target misorientation distribution, such as a histogram measured by EBSD. When given,
+        swaps are only kept when they bring the histogram of the grain boundary
+        misorientations closer to it, instead of following minimize.
+    bins : array or None
+        Edges of the target histogram in degrees. Defaults to equal bins up to the largest
+        disorientation of the lattice.
+    weighted : bool
+        Weight every grain boundary by its area in voxel faces rather than counting edges.
+    callback : callable or None
+        Function called every report_frequency iterations with a dictionary of metrics: the
+        cumulative seconds spent to propose, swap and output under timings, the fraction of
+        accepted swaps and the energy, see network_energy and subsurface.monitor.Monitor.
+    report_frequency : int
+        Number of iterations between calls of the callback.
+    progress_interval : float or None
+        Wall time in seconds between progress lines. Defaults to None, to run silently.
+    checkpoint : str or None
+        HDF5 file to write the state of the shuffle to, see resume_shuffle. The
+        emitted outputs are appended to checkpoint + '.history'.
+    checkpoint_interval : float
+        Wall time in seconds between checkpoints. The last iteration is always saved.
 
     Returns
     -------
-    shuffled_orientations : list
-        List of shuffled orientations for every nth shuffle increment.
+    shuffled_orientations : list or SwapLog
+        List of shuffled orientations for every nth shuffle increment, or the log of all swaps.
     misorientations : list (optional)
-        Unstructured list of misorientations.
+        Unstructured list of misorientations, of the final arrangement for a SwapLog.
     misorientation_change : list (optional)
-        List of average misorientation values for each increment.
+        List of average misorientation values for each increment, or of the squared distance to
+        the target histogram, not returned with a SwapLog.
     """
 
+    if output not in ['orientations','log']:
+        raise ValueError(f"Unknown output '{output}', expected 'orientations' or 'log'")
+
+    if target is not None and batch > 1:
+        raise ValueError('Matching a target distribution evaluates one swap at a time, batch must be 1')
+
     # Quick catch to account for no exclusions
     exclude = [] if exclude is None else exclude
 
     # Firstly we need to identify what grains are near eachother.
-    nearest_grains = find_neighbour_grains(material)
+    if weighted:
+        indptr,indices,counts = find_neighbour_grains(material,return_counts=True,n_grains=len(orientation))
+    else:
+        indptr,indices = find_neighbour_grains(material,n_grains=len(orientation))
+        counts = None
 
-    misorientation_change = []
-    orientations = []
+    # The symmetry operators are only looked up once
+    operators = symmetry_operators(lattice)
 
-    for idx in range(iterations):
+    # The histogram is only tracked when matching a target
+    if target is not None:
+        target = np.asarray(target,dtype=float)/np.sum(target)
 
-        # Determine the new orientations.
-        orientation, change = find_new_arrangement(orientation,nearest_grains,exclude,minimize,family,lattice,return_misorientation=True)
+        if bins is None:
+            bins = np.linspace(0,maximum_disorientation[lattice_families[lattice]],len(target)+1)
 
-        # Save every output_frequency increment
-        if (idx % output_frequency)==0:
-            misorientation_change.append(change)
-            orientations.append(orientation)
+    else:
+        bins = None
 
-    if return_full:
+    # The misorientation of every grain boundary is tracked through the swaps
+    network = MisorientationNetwork(orientation,indptr,indices,operators,bins=bins,counts=counts)
+
+    # Grains that may be swapped, drawn in batches
+    eligible = np.setdiff1d(np.arange(len(orientation)),exclude)
+
+    parameters = dict(iterations=iterations,
+                      return_full=return_full,
+                      minimize=minimize,
+                      family=family,
+                      lattice=lattice,
+                      output_frequency=output_frequency,
+                      batch=batch,
+                      output=output,
+                      keyframe_frequency=keyframe_frequency,
+                      target=target,
+                      bins=bins)
+
+    outputs = dict(assignment=[],change=[],log=SwapLog(orientation,keyframe_frequency) if output == 'log' else None)
+
+    checkpointer = None if checkpoint is None else Checkpoint(checkpoint,checkpoint_interval)
+
+    return _shuffle(network,counts,eligible,parameters,rng,dict(idx=0,n_accepted=0),outputs,
+                    Monitor(iterations,callback,report_frequency,progress_interval,label='Shuffling'),checkpointer)
+
+
+def resume_shuffle(filename,checkpoint_interval=300.0,callback=None,report_frequency=1000,progress_interval=None):
+    """
+    Function to continue a Shuffle from its last checkpoint.
+
+    The shuffle continues exactly as it would have without the interruption and
+    keeps writing checkpoints to the same file. The material is not needed, as
+    the checkpoint holds the grain adjacency.
+
+    Parameters
+    ----------
+    filename : str
+        Checkpoint file written by Shuffle.
+    checkpoint_interval : float
+        Wall time in seconds between checkpoints.
+    callback, report_frequency, progress_interval
+        See Shuffle.
+
+    Returns
+    -------
+    The outputs of Shuffle, including those emitted before the checkpoint.
+    """
+
+    arrays,attributes = load_checkpoint(filename)
+
+    if attributes['kind'] != 'Shuffle':
+        raise ValueError(f"{filename} is a checkpoint of {attributes['kind']}, not Shuffle")
+
+    parameters = attributes['parameters']
+    parameters['target'] = arrays.get('parameters/target')
+    parameters['bins'] = arrays.get('parameters/bins')
+
+    counts = arrays.get('graph/counts')
+
+    network = MisorientationNetwork(arrays['graph/orientations'],arrays['graph/indptr'],arrays['graph/indices'],
+                                    symmetry_operators(parameters['lattice']),bins=parameters['bins'],counts=counts)
+    network.assign(arrays['state/network'])
+
+    state = dict(attributes['state'])
+
+    if 'state/pairs' in arrays:
+        state['pairs'] = arrays['state/pairs'].tolist()
+    if 'state/assignment' in arrays:
+        state['assignment'] = arrays['state/assignment']
+
+    outputs = dict(assignment=list(arrays['outputs/assignment']),change=arrays['outputs/change'].tolist(),log=None)
+
+    if parameters['output'] == 'log':
+        log = SwapLog(arrays['graph/orientations'],parameters['keyframe_frequency'])
+
+        log.record(arrays['log/step'],arrays['log/pairs'],arrays['log/change'])
+        log.keyframe_step = arrays['log/keyframe_step'].tolist()
+        log.keyframe_assignment = list(arrays['log/keyframe_assignment'])
+
+        outputs['log'] = log
+
+    rng = restore_rng(attributes['rng']['state'],attributes['rng']['generator'])
+
+    return _shuffle(network,counts,arrays['eligible'],parameters,rng,state,outputs,
+                    Monitor(parameters['iterations'],callback,report_frequency,progress_interval,label='Shuffling'),
+                    Checkpoint(filename,checkpoint_interval,resume=True))
+
+
+def _shuffle(network,counts,eligible,parameters,rng,state,outputs,monitor,checkpointer):
+
+    iterations = parameters['iterations']
+    minimize = parameters['minimize']
+    output_frequency = parameters['output_frequency']
+    batch = parameters['batch']
+    target = parameters['target']
+
+    indptr,indices = network.indptr,network.indices
+
+    log = outputs['log']
+    batch_size = 4096
+
+    label_dtype = get_label_dtype(len(network.assignment))
+
+    idx = state['idx']
+    n_accepted = state['n_accepted']
+    pairs = state.get('pairs')
+    assignment = state.get('assignment')
+
+    while idx < iterations:
+
+        monitor.stage('propose')
+
+        if batch > 1:
+
+            # Keep the candidates that can be evaluated independently of each other
+            pairs = choose_independent_pairs(indptr,indices,choose_pairs(eligible,batch,rng),iterations-idx)
+            previous = network.assignment.copy()
+
+            monitor.stage('swap')
+
+            changes,accepted = find_new_arrangements(network,pairs[:,0],pairs[:,1],minimize)
+            n_accepted += np.count_nonzero(accepted)
+
+            monitor.stage('output')
+
+            if log is not None:
+                log.record(idx+np.flatnonzero(accepted),pairs[accepted],changes[accepted])
+                log.update(idx+len(pairs),network.assignment)
+
+            # Save every output_frequency increment, replaying the accepted swaps up to it
+            else:
+                for position in range(-idx % output_frequency,len(pairs),output_frequency):
+                    i,j = pairs[:position+1][accepted[:position+1]].T
+
+                    assignment = previous.copy()
+                    assignment[i],assignment[j] = previous[j],previous[i]
+
+                    outputs['change'].append(changes[position])
+                    outputs['assignment'].append(assignment.astype(label_dtype))
+
+            idx += len(pairs)
+
+        else:
+
+            if (idx % batch_size)==0:
+                pairs = choose_pairs(eligible,min(batch_size,iterations-idx),rng).tolist()
+
+            # Determine the new orientations.
+            i,j = pairs[idx % batch_size]
+
+            monitor.stage('swap')
+
+            if target is None:
+                change = find_new_arrangement(network,i,j,minimize)
+            else:
+                change = find_matched_arrangement(network,i,j,target)
+
+            accepted = change < 0 or not (minimize or target is not None)
+            n_accepted += accepted
+
+            monitor.stage('output')
+
+            if log is not None:
+                if accepted:
+                    log.record(idx,(i,j),change)
+
+                log.update(idx+1,network.assignment)
+
+            # Save every output_frequency increment
+            elif (idx % output_frequency)==0:
+                outputs['change'].append(change)
+                outputs['assignment'].append(network.assignment.astype(label_dtype))
+                assignment = network.assignment.copy()
+
+            idx += 1
+
+        # The energy is only evaluated when it is reported
+        if monitor.due(idx-1):
+            monitor.update(idx-1,acceptance_rate=n_accepted/idx,energy=network_energy(network,target))
+        else:
+            monitor.stage(None)
+
+        # The last iteration is always saved so a finished shuffle can be resumed to its outputs
+        if checkpointer is not None and (checkpointer.due() or idx >= iterations):
+            state.update(idx=idx,n_accepted=n_accepted,pairs=pairs if batch == 1 else None,assignment=assignment)
+            _save_shuffle(checkpointer,network,counts,eligible,parameters,rng,state,outputs)
+
+    if log is not None:
+
+        log.update(iterations,network.assignment,force=True)
+
+        return (log,network.distribution().tolist()) if parameters['return_full'] else log
+
+    orientations = [network.table.orientations[emitted] for emitted in outputs['assignment']]
+
+    if parameters['return_full']:
         
-        misorientation = find_misorientation(orientations[-1],nearest_grains,family,lattice)
+        misorientation = network.distribution(assignment).tolist()
 
-        return orientations,misorientation,misorientation_change
+        return orientations,misorientation,outputs['change']
 
     else: 
         return orientations
 
+def _save_shuffle(checkpointer,network,counts,eligible,parameters,rng,state,outputs):
+
+    n_grains = len(network.assignment)
+
+    constant = {'graph/orientations':network.table.orientations,
+                'graph/indptr':network.indptr,
+                'graph/indices':network.indices,
+                'eligible':eligible}
+
+    for name,array in [('graph/counts',counts),
+                       ('parameters/target',parameters['target']),
+                       ('parameters/bins',parameters['bins'])]:
+        if array is not None:
+            constant[name] = array
+
+    arrays = {'state/network':network.assignment}
+
+    for name,array in [('state/pairs',state['pairs']),
+                       ('state/assignment',state['assignment'])]:
+        if array is not None:
+            arrays[name] = array
+
+    # Only the outputs emitted since the last checkpoint are written
+    new = lambda name,rows: rows[checkpointer.written(name):]
+
+    append = {'outputs/assignment':np.array(new('outputs/assignment',outputs['assignment']),dtype=get_label_dtype(n_grains)).reshape(-1,n_grains),
+              'outputs/change':np.array(new('outputs/change',outputs['change']),dtype=float)}
+
+    log = outputs['log']
+
+    if log is not None:
+        append.update({'log/step':np.array(new('log/step',log._step),dtype=np.int64),
+                       'log/pairs':np.array(new('log/pairs',log._pairs),dtype=np.int64).reshape(-1,2),
+                       'log/change':np.array(new('log/change',log._change),dtype=float),
+                       'log/keyframe_step':np.array(new('log/keyframe_step',log.keyframe_step),dtype=np.int64),
+                       'log/keyframe_assignment':np.array(new('log/keyframe_assignment',log.keyframe_assignment),dtype=get_label_dtype(n_grains)).reshape(-1,n_grains)})
 
-def find_misorientation(orientations,nearest_grains,family,lattice):
+    attributes = dict(kind='Shuffle',
+                      parameters={name:value for name,value in parameters.items() if name not in ['target','bins']},
+                      state={name:state[name] for name in ['idx','n_accepted']},
+                      rng=dict(generator=rng is not None,state=get_rng_state(rng)))
+
+    checkpointer.save(arrays,attributes,constant,append)
+
+
+def TemperedShuffle(material,orientation,iterations,temperatures,exclude=None,return_full=False,lattice='cI',exchange_frequency=100,processes=None,seed=None):
     """
-    Wrapper for the find_local_misorientation code.
+    Function to shuffle the orientations with replicas at several temperatures over a process pool.
+
+    Every replica makes Metropolis swaps on the mean grain boundary misorientation,
+    a replica at zero temperature only keeps swaps that lower it. After every
+    exchange_frequency iterations neighbouring temperatures exchange their
+    arrangements with probability min(1, exp((E_i - E_j)(1/T_i - 1/T_j))), so
+    arrangements found by the hot replicas can drift down to the coldest one.
+    The neighbour graph and orientations are placed in shared memory once.
 
     Parameters
     ----------
+    material : array (:,:,:)
+        Three dimensional representative volume element as an array of material points.
     orientations : list
         List of quaternions that represent the grain orientations.
-    neighbour_grains : list
-        List of lists containing the nearest neighbour grains to each grain.
+    iterations : int
+        Number of iterations of every replica.
+    temperatures : list
+        Temperature of each replica in degrees, in increasing order.
+    exclude : list or None
+        List of material indices to exlude from the shuffling operation.
+    return_full : bool
+        Request that the shuffle operation returns the misorientation distribution and energies.
+    lattice : str
+        Lattice to consider - see damask.Orientation for full description.
+    exchange_frequency : int
+        Number of iterations between exchanges.
+    processes : int | None
+        Number of worker processes. Defaults to the number of cores.
+    seed : int | None
+        Entropy for the SeedSequence the replica generators are spawned from.
+
+    Returns
+    -------
+    shuffled_orientations : list
+        Orientations of the coldest replica after every exchange.
+    misorientations : list (optional)
+        Unstructured list of misorientations of the final coldest replica.
+    energy : array (:,:) (optional)
+        Mean grain boundary misorientation at every temperature after every exchange.
+    """
+
+    # Quick catch to account for no exclusions
+    exclude = [] if exclude is None else exclude
+
+    temperatures = np.asarray(temperatures,dtype=float)
+    orientation = np.asarray(orientation,dtype=float)
+
+    indptr,indices = find_neighbour_grains(material,n_grains=len(orientation))
+    eligible = np.setdiff1d(np.arange(len(orientation)),exclude)
+
+    # One generator per replica and one for the exchanges
+    streams = np.random.SeedSequence(seed).spawn(len(temperatures)+1)
+    rng = np.random.default_rng(streams[0])
+    generators = [np.random.default_rng(stream) for stream in streams[1:]]
+
+    assignments = [np.arange(len(orientation))]*len(temperatures)
+
+    orientations = []
+    energy = []
+
+    blocks = []
+    descriptors = {}
+
+    try:
+        for name,array in [('orientations',orientation),('indptr',indptr),('indices',indices),('eligible',eligible)]:
+            block,descriptors[name] = share_array(array)
+            blocks.append(block)
+
+        with multiprocessing.Pool(processes,initializer=_initialise_shuffle_worker,initargs=(descriptors,lattice)) as pool:
+
+            for exchange,start in enumerate(range(0,iterations,exchange_frequency)):
+
+                tasks = [(assignment,temperature,generator,min(exchange_frequency,iterations-start))
+                         for assignment,temperature,generator in zip(assignments,temperatures,generators)]
+
+                assignments,energies,generators = map(list,zip(*pool.starmap(_run_replica_worker,tasks)))
+
+                # Alternate between the even and odd pairs of neighbouring temperatures
+                for k in range(exchange % 2,len(temperatures)-1,2):
+
+                    if rng.random() < exchange_probability(energies[k],energies[k+1],temperatures[k],temperatures[k+1]):
+                        assignments[k],assignments[k+1] = assignments[k+1],assignments[k]
+                        energies[k],energies[k+1] = energies[k+1],energies[k]
+
+                orientations.append(orientation[assignments[0]])
+                energy.append(energies)
+
+    finally:
+        release(blocks)
+
+    if return_full:
+
+        network = MisorientationNetwork(orientation,indptr,indices,symmetry_operators(lattice))
+
+        misorientation = network.distribution(assignments[0]).tolist()
+
+        return orientations,misorientation,np.array(energy)
+
+    else:
+        return orientations
+
+
+# Neighbour graph of the tempered shuffle and the shared memory it views, one per worker process
+_worker_network = None
+_worker_eligible = None
+_worker_blocks = []
+
+def _initialise_shuffle_worker(descriptors,lattice):
+
+    global _worker_network, _worker_eligible
+
+    arrays = {}
+
+    for name,descriptor in descriptors.items():
+        block,arrays[name] = attach_array(descriptor)
+        _worker_blocks.append(block)
+
+    _worker_network = MisorientationNetwork(arrays['orientations'],arrays['indptr'],arrays['indices'],symmetry_operators(lattice))
+    _worker_eligible = arrays['eligible']
+
+def _run_replica_worker(assignment,temperature,rng,iterations):
+
+    network = _worker_network
+    network.assign(assignment)
+
+    for i,j in choose_pairs(_worker_eligible,iterations,rng).tolist():
+        find_tempered_arrangement(network,i,j,temperature,rng)
+
+    return network.assignment,np.mean(network.omega),rng
+
+
+class MisorientationNetwork:
+    def __init__(self,
+                 orientations: np.ndarray,
+                 indptr: np.ndarray,
+                 indices: np.ndarray,
+                 operators: np.ndarray,
+                 table: DisorientationTable | None = None,
+                 bins: np.ndarray | None = None,
+                 counts: np.ndarray | None = None,
+                 ):
+        """
+        Misorientation of every edge of the grain adjacency graph.
+
+        Grains hold an index into a fixed set of orientations, so a swap only
+        exchanges two indices. Only the edges incident to the swapped grains
+        are updated, their angles come from a memo keyed by orientation index,
+        and the last swap can be rolled back. When bins are given a histogram of
+        the edge misorientations is kept up to date with every swap as well.
+
+        Parameters
+        ----------
+        orientations : array (:,4)
+            Quaternions that represent the grain orientations.
+        indptr : array
+            Offsets of the neighbours of each grain, see find_neighbour_grains.
+        indices : array
+            Neighbour grain indices of every grain, see find_neighbour_grains.
+        operators : array (:,4)
+            Symmetry operators of the lattice.
+        table : DisorientationTable or None
+            Memo of the disorientation between orientation pairs. Defaults to a new one.
+        bins : array or None
+            Edges of the misorientation histogram in degrees, angles beyond them count in the outer bins.
+        counts : array or None
+            Shared voxel faces of every neighbour, see find_neighbour_grains, to weight
+            the histogram by boundary area rather than by the number of edges.
+        """
+        self.table = DisorientationTable(orientations,operators) if table is None else table
+        self.bins = bins
+        self.indptr = indptr
+        self.indices = indices
+
+        n_grains = len(indptr)-1
+        source = np.repeat(np.arange(n_grains),np.diff(indptr))
+
+        # Every edge is stored once, from the lower to the higher grain index
+        upper = source < indices
+        self.edge_source = source[upper]
+        self.edge_target = indices[upper]
+
+        # Edge of each entry in the adjacency
+        edge_key = self.edge_source*n_grains + self.edge_target
+        self.entry_edge = np.searchsorted(edge_key,np.minimum(source,indices)*n_grains + np.maximum(source,indices))
+
+        self.weights = np.ones(len(edge_key)) if counts is None else np.asarray(counts,dtype=float)[upper]
+
+        self.assign(np.arange(len(orientations)))
+
+    def assign(self,assignment):
+        """Replace the orientation index of every grain and recalculate all edges."""
+        self.assignment = np.array(assignment)
+
+        self.omega = self.table(self.assignment[self.edge_source],self.assignment[self.edge_target])
+        self.total = np.sum(self.omega)
+
+        if self.bins is not None:
+            self.histogram = np.bincount(self.binned(self.omega),self.weights,len(self.bins)-1)
+
+        self._undo = None
+
+    def binned(self,omega):
+        """Histogram bin of misorientation angles."""
+        return np.clip(np.searchsorted(self.bins,omega,side='right')-1,0,len(self.bins)-2)
+
+    def _rebin(self,edges,previous):
+
+        # Move the weight of the edges from the bins of their previous angles to their current ones
+        if self.bins is not None:
+            self.histogram += (np.bincount(self.binned(self.omega[edges]),self.weights[edges],len(self.bins)-1)
+                               - np.bincount(self.binned(previous),self.weights[edges],len(self.bins)-1))
+
+    @property
+    def orientations(self) -> np.ndarray:
+        """Quaternions of the current grain orientations."""
+        return self.table.orientations[self.assignment]
+
+    def edges(self,grain):
+        """Edges incident to a grain."""
+        return self.entry_edge[self.indptr[grain]:self.indptr[grain+1]]
+
+    def local_misorientation(self,grain):
+        """Misorientation angles to the neighbours of a grain in degrees."""
+        return self.omega[self.edges(grain)]
+
+    def swap(self,i,j):
+        """Swap the orientations of grains i and j and update their edges."""
+        self.assignment[[i,j]] = self.assignment[[j,i]]
+
+        edges = np.union1d(self.edges(i),self.edges(j))
+
+        self._undo = (i,j,edges,self.omega[edges],self.total)
+
+        self.omega[edges] = self.table(self.assignment[self.edge_source[edges]],self.assignment[self.edge_target[edges]])
+        self.total = self._undo[-1] + np.sum(self.omega[edges]) - np.sum(self._undo[3])
+
+        self._rebin(edges,self._undo[3])
+
+    def undo(self):
+        """Roll back the last swap."""
+        i,j,edges,omega,total = self._undo
+
+        self.assignment[[i,j]] = self.assignment[[j,i]]
+        current = self.omega[edges]
+        self.omega[edges] = omega
+        self.total = total
+
+        self._rebin(edges,current)
+
+        self._undo = None
+
+    def entries(self,grains):
+        """Adjacency entries of a set of grains and the position in grains of the grain each belongs to."""
+        start = self.indptr[grains]
+        length = self.indptr[grains+1]-start
+
+        owner = np.repeat(np.arange(len(grains)),length)
+        entries = np.arange(np.sum(length)) + np.repeat(start-np.cumsum(length)+length,length)
+
+        return entries,owner
+
+    def local_mean_misorientation(self,grains):
+        """Mean misorientation to the neighbours of each of a set of grains in degrees."""
+        entries,owner = self.entries(grains)
+
+        with np.errstate(invalid='ignore'):
+            return np.bincount(owner,weights=self.omega[self.entry_edge[entries]],minlength=len(grains))/(self.indptr[grains+1]-self.indptr[grains])
+
+    def swap_batch(self,i,j):
+        """
+        Swap the orientations of the grain pairs i[k] and j[k] and update their edges.
+
+        The pairs must not share an edge with each other, see choose_independent_pairs,
+        so that every swap can be rolled back on its own by undo_batch.
+        """
+        entries,owner = self.entries(np.concatenate([i,j]))
+
+        # Edge (i[k],j[k]) is listed by both grains of the swap
+        edges,first = np.unique(self.entry_edge[entries],return_index=True)
+
+        self.assignment[i],self.assignment[j] = self.assignment[j],self.assignment[i]
+
+        self._undo = (i,j,edges,owner[first] % len(i),self.omega[edges],self.total)
+
+        self.omega[edges] = self.table(self.assignment[self.edge_source[edges]],self.assignment[self.edge_target[edges]])
+        self.total = self._undo[-1] + np.sum(self.omega[edges]) - np.sum(self._undo[4])
+
+        self._rebin(edges,self._undo[4])
+
+    def undo_batch(self,rejected):
+        """Roll back the swaps of the last swap_batch selected by the boolean mask rejected."""
+        i,j,edges,owner,omega,total = self._undo
+
+        i,j = i[rejected],j[rejected]
+        self.assignment[i],self.assignment[j] = self.assignment[j],self.assignment[i]
+
+        restore = rejected[owner]
+        current = self.omega[edges[restore]]
+
+        self.total = self.total + np.sum(omega[restore]) - np.sum(current)
+        self.omega[edges[restore]] = omega[restore]
+
+        self._rebin(edges[restore],current)
+
+        self._undo = None
+
+    def distribution(self,assignment=None):
+        """
+        Misorientation angles seen from every grain, so each edge appears twice.
+
+        Parameters
+        ----------
+        assignment : array or None
+            Orientation index of every grain to evaluate instead of the current one.
+        """
+        if assignment is None:
+            return self.omega[self.entry_edge]
+
+        return self.table(assignment[self.edge_source],assignment[self.edge_target])[self.entry_edge]
+
+
+class SwapLog:
+    def __init__(self,
+                 orientations: np.ndarray,
+                 keyframe_frequency: int = 10000,
+                 ):
+        """
+        Compact history of a shuffle as the accepted swaps and periodic keyframes.
+
+        Instead of a copy of every orientation array, only the grain pairs of the
+        accepted swaps are recorded together with the arrangement of the grains
+        every keyframe_frequency iterations. The orientations at any iteration
+        are rebuilt from the nearest earlier keyframe.
+
+        Parameters
+        ----------
+        orientations : array (:,4)
+            Quaternions that represent the initial grain orientations.
+        keyframe_frequency : int
+            Number of iterations between stored arrangements.
+        """
+        self.initial = np.asarray(orientations,dtype=float)
+        self.keyframe_frequency = keyframe_frequency
+
+        self._step = []
+        self._pairs = []
+        self._change = []
+
+        self.keyframe_step = []
+        self.keyframe_assignment = []
+
+        self.update(0,np.arange(len(self.initial)),force=True)
+
+    def __len__(self):
+        return len(self._step)
+
+    @property
+    def step(self) -> np.ndarray:
+        """Iteration of every accepted swap."""
+        return np.array(self._step,dtype=np.int64)
+
+    @property
+    def pairs(self) -> np.ndarray:
+        """Grains exchanged by every accepted swap."""
+        return np.array(self._pairs,dtype=np.int64).reshape(-1,2)
+
+    @property
+    def change(self) -> np.ndarray:
+        """Change in misorientation of every accepted swap."""
+        return np.array(self._change,dtype=float)
+
+    @property
+    def iterations(self) -> int:
+        """Number of iterations covered by the log."""
+        return self.keyframe_step[-1]
+
+    def record(self,step,pairs,change):
+        """
+        Record accepted swaps.
+
+        Parameters
+        ----------
+        step : int or array
+            Iteration of each swap.
+        pairs : tuple or array (:,2)
+            Grains exchanged by each swap.
+        change : float or array
+            Change in misorientation of each swap.
+        """
+        if np.ndim(step) == 0:
+            self._step.append(int(step))
+            self._pairs.append(tuple(pairs))
+            self._change.append(float(change))
+
+        else:
+            self._step.extend(np.asarray(step).tolist())
+            self._pairs.extend(map(tuple,np.asarray(pairs).tolist()))
+            self._change.extend(np.asarray(change).tolist())
+
+    def update(self,step,assignment,force=False):
+        """Store the arrangement after step iterations when a keyframe is due."""
+        if force or step >= self.keyframe_step[-1] + self.keyframe_frequency:
+
+            if self.keyframe_step and step == self.keyframe_step[-1]:
+                return
+
+            self.keyframe_step.append(int(step))
+            self.keyframe_assignment.append(np.asarray(assignment).astype(get_label_dtype(len(self.initial))))
+
+    def assignment(self,step=None):
+        """
+        Index into the initial orientations of every grain after a number of iterations.
+
+        Parameters
+        ----------
+        step : int or None
+            Number of iterations. Defaults to the end of the log.
+        """
+        step = self.iterations if step is None else step
+
+        if not 0 <= step <= self.iterations:
+            raise ValueError(f'Step {step} is outside the logged {self.iterations} iterations')
+
+        keyframe = np.searchsorted(self.keyframe_step,step,side='right')-1
+
+        assignment = self.keyframe_assignment[keyframe].astype(np.int64)
+
+        # Replay the swaps between the keyframe and the requested step
+        steps = self.step
+        start,stop = np.searchsorted(steps,[self.keyframe_step[keyframe],step])
+
+        for i,j in self._pairs[start:stop]:
+            assignment[i],assignment[j] = assignment[j],assignment[i]
+
+        return assignment
+
+    def orientations(self,step=None):
+        """Quaternions of the grain orientations after a number of iterations."""
+        return self.initial[self.assignment(step)]
+
+    def save(self,filename):
+        """Write the log to a compressed numpy archive."""
+        np.savez_compressed(filename,
+                            initial=self.initial,
+                            keyframe_frequency=self.keyframe_frequency,
+                            step=self.step,
+                            pairs=self.pairs,
+                            change=self.change,
+                            keyframe_step=np.array(self.keyframe_step,dtype=np.int64),
+                            keyframe_assignment=np.array(self.keyframe_assignment))
+
+    @classmethod
+    def load(cls,filename):
+        """Read a log written by save."""
+        with np.load(filename) as data:
+
+            log = cls(data['initial'],int(data['keyframe_frequency']))
+
+            log.record(data['step'],data['pairs'],data['change'])
+
+            log.keyframe_step = data['keyframe_step'].tolist()
+            log.keyframe_assignment = list(data['keyframe_assignment'])
+
+        return log
+
+
+def find_misorientation(orientations,indptr,indices,family,lattice,operators=None):
+    """
+    Misorientation angles across every edge of the grain adjacency graph.
+
+    Parameters
+    ----------
+    orientations : list
+        List of quaternions that represent the grain orientations.
+    indptr : array
+        Offsets of the neighbours of each grain, see find_neighbour_grains.
+    indices : array
+        Neighbour grain indices of every grain, see find_neighbour_grains.
     family : str
         Slip family to consider - see damask.Orientation for full description.
     lattice : str
         Lattice to consider - see damask.Orientation for full description.
+    operators : array (:,4) or None
+        Symmetry operators of the lattice, looked up when not given.
 
     Returns
     -------
-    distribution : list
-        Unstructured list of all misorientation angles.
+    distribution : array
+        Misorientation angles measured in degrees seen from every grain in turn,
+        so each edge appears twice.
     
     """
 
-    distribution = []
+    operators = symmetry_operators(lattice) if operators is None else operators
 
-    for idx in range(len(orientations)):
-        
-        distribution.extend(find_local_misorientation(orientations,nearest_grains,idx,family,lattice))
+    network = MisorientationNetwork(np.asarray(orientations,dtype=float),np.asarray(indptr),np.asarray(indices),operators)
 
-    return distribution
+    return network.distribution()
 
 
 
-def find_local_misorientation(orientations,nearest_grains,seed_index,family,lattice):
+def find_local_misorientation(orientations,indptr,indices,seed_index,family,lattice,operators=None):
     """
-    For a given index, this function will calculate the local misorientation and return a list of angles.
+    For a given index, this function will calculate the local misorientation and return the angles.
 
     Parameters
     ----------
     orientations : list
         List of quaternions that represent the grain orientations.
-    neighbour_grains : list
-        List of lists containing the nearest neighbour grains to each grain.
+    indptr : array
+        Offsets of the neighbours of each grain, see find_neighbour_grains.
+    indices : array
+        Neighbour grain indices of every grain, see find_neighbour_grains.
     seed_index: int
         Index to calculate the local misorientation around.
     family : str
         Slip family to consider - see damask.Orientation for full description.
     lattice : str
         Lattice to consider - see damask.Orientation for full description.
+    operators : array (:,4) or None
+        Symmetry operators of the lattice, looked up when not given.
 
     Returns
     -------
-    omega : list
-        Unstructured list of misorientation angles measured in degrees.
+    omega : array
+        Misorientation angles to the neighbours of the grain measured in degrees.
     
     """
     
-    # Find all the equivalent orientations.
-    reference_orientation =  damask.Orientation.from_quaternion(q=orientations[seed_index],lattice=lattice) # 230 ms
-    
-    # Find the neighbour orientations.
-    nearest_orientations = [orientations[i] for i in nearest_grains]
-    neighbour_orientations = damask.Orientation.from_quaternion(q=nearest_orientations[seed_index],lattice=lattice)
+    operators = symmetry_operators(lattice) if operators is None else operators
 
-    # Find the misorientation angle
-    #n,omega = reference_orientation.disorientation(neighbour_orientations).as_axis_angle(degrees=True,pair=True)
+    orientations = np.asarray(orientations,dtype=float)
+    neighbours = indices[indptr[seed_index]:indptr[seed_index+1]]
 
-    omega = reference_orientation.disorientation_angle(neighbour_orientations)*180/np.pi
+    # Find the misorientation angle to every neighbour in one batch
+    omega = disorientation_angle(orientations[seed_index],orientations[neighbours],operators)
     
     return omega
 
 
-def find_new_arrangement(orientations,nearest_grains,exclude,minimize,family,lattice,return_misorientation=False):
+def find_new_arrangement(network,i,j,minimize):
     """
-    Function to shuffle the orientations and calculate the misorientation.
+    Function to swap the orientations of two grains and calculate the change in misorientation.
 
     Parameters
     ----------
-    orientations : list
-        List of quaternions that represent the grain orientations.
-    neighbour_grains : list
-        List of lists containing the nearest neighbour grains to each grain.
-    exclude : list or None
-        List of material indices to exlude from the shuffling operation.
+    network : MisorientationNetwork
+        Orientations and grain boundary misorientations, updated in place.
+    i,j : int
+        Grains to swap.
     minimize : bool
         Option to minimise the overall misorientation.
-    family : str
-        Slip family to consider - see damask.Orientation for full description.
-    lattice : str
-        Lattice to consider - see damask.Orientation for full description.
 
     Returns
     -------
-    new_orientations : list
-        List of shuffled orientations.
+    misorientation_change : float
+        Change in the mean local misorientation of the two swapped grains, zero when rejected.
+    """
+
+    previous_misorientation = np.mean(network.local_misorientation(i))+np.mean(network.local_misorientation(j))
+
+    network.swap(i,j)
+
+    current_misorientation = np.mean(network.local_misorientation(i))+np.mean(network.local_misorientation(j))
+
+    misorientation_change = current_misorientation - previous_misorientation
+
+    if minimize and not current_misorientation < previous_misorientation:
+
+        network.undo()
+
+        return 0
+
+    return misorientation_change
+
+def find_matched_arrangement(network,i,j,target):
+    """
+    Function to swap the orientations of two grains when it brings the misorientation histogram closer to a target.
+
+    Parameters
+    ----------
+    network : MisorientationNetwork
+        Orientations and grain boundary misorientations with a histogram, updated in place.
+    i,j : int
+        Grains to swap.
+    target : array
+        Target histogram normalised to sum to one, over the bins of the network.
+
+    Returns
+    -------
+    error_change : float
+        Change in the squared distance to the target, zero when rejected.
     """
 
-    i,j = choose(0,len(orientations),exclude),choose(0,len(orientations),exclude)
+    previous_error = histogram_error(network.histogram,target)
 
-    local_misorientation_home = find_local_misorientation(orientations,nearest_grains,seed_index=i,family=family,lattice=lattice) # What is the local misorientation on seed i?
-    local_misorientation_away = find_local_misorientation(orientations,nearest_grains,seed_index=j,family=family,lattice=lattice) # What is the local misorientation on seed j?
+    network.swap(i,j)
 
-    previous_misorientation = np.mean(local_misorientation_home)+np.mean(local_misorientation_away)
+    current_error = histogram_error(network.histogram,target)
 
-    new_orientations = switch(orientations,locations=[i,j])
+    if not current_error < previous_error:
 
-    local_misorientation_home = find_local_misorientation(new_orientations,nearest_grains,seed_index=i,family=family,lattice=lattice)
-    local_misorientation_away = find_local_misorientation(new_orientations,nearest_grains,seed_index=j,family=family,lattice=lattice)
+        network.undo()
 
-    current_misorientation = np.mean(local_misorientation_home)+np.mean(local_misorientation_away)
+        return 0
+
+    return current_error - previous_error
+
+def network_energy(network,target=None):
+    """
+    Mean grain boundary misorientation of a network, or the squared distance of its histogram to a target.
+    """
+
+    if target is None:
+        return network.total/len(network.omega)
+
+    return histogram_error(network.histogram,target)
+
+def histogram_error(histogram,target):
+    """
+    Squared distance between a histogram and a target histogram that sums to one.
+    """
+
+    return np.sum((histogram/np.sum(histogram) - target)**2)
+
+def find_new_arrangements(network,i,j,minimize):
+    """
+    Function to swap the orientations of several independent grain pairs at once.
+
+    Every swap is accepted or rejected exactly as find_new_arrangement would when
+    the pairs are evaluated one after the other.
+
+    Parameters
+    ----------
+    network : MisorientationNetwork
+        Orientations and grain boundary misorientations, updated in place.
+    i,j : array of int
+        Grains to swap, from choose_independent_pairs.
+    minimize : bool
+        Option to minimise the overall misorientation.
+
+    Returns
+    -------
+    misorientation_change : array
+        Change in the mean local misorientation of the two grains of every swap, zero when rejected.
+    accepted : array of bool
+        Swaps that were kept.
+    """
+
+    grains = np.concatenate([i,j])
+
+    previous_misorientation = network.local_mean_misorientation(grains).reshape(2,-1).sum(axis=0)
+
+    network.swap_batch(i,j)
+
+    current_misorientation = network.local_mean_misorientation(grains).reshape(2,-1).sum(axis=0)
 
     misorientation_change = current_misorientation - previous_misorientation
 
     if minimize:
 
-        if return_misorientation==False:
-            if current_misorientation < previous_misorientation:
-                return new_orientations
+        accepted = current_misorientation < previous_misorientation
 
-            else:
-                return orientations
-        
-        elif return_misorientation==True:
-            if current_misorientation < previous_misorientation:
-                return new_orientations, misorientation_change
+        network.undo_batch(~accepted)
+
+        misorientation_change[~accepted] = 0
 
-            else:
-                return orientations, 0
-        
     else:
-        return new_orientations
+        accepted = np.ones(len(i),dtype=bool)
+
+    return misorientation_change,accepted
 
-def find_neighbour_grains(material):
+def find_tempered_arrangement(network,i,j,temperature,rng=None):
     """
-    Function to find the neighbouring grains to grains in a material RVE.
+    Function to swap the orientations of two grains with the Metropolis criterion.
 
     Parameters
     ----------
-    material : array (:,:,:)
-        Three dimensional representative volume element as an array of material points.
+    network : MisorientationNetwork
+        Orientations and grain boundary misorientations, updated in place.
+    i,j : int
+        Grains to swap.
+    temperature : float
+        Temperature in degrees, zero only accepts swaps that lower the misorientation.
+    rng : np.random.Generator or None
+        Random number generator. Defaults to the global numpy state.
 
     Returns
     -------
-    neighbour_grains : list
-        List of lists containing the nearest neighbour grains to each grain.
+    misorientation_change : float
+        Change in the mean grain boundary misorientation, zero when rejected.
+    """
+
+    rng = np.random if rng is None else rng
+
+    previous_total = network.total
+
+    network.swap(i,j)
+
+    misorientation_change = (network.total - previous_total)/len(network.omega)
+
+    if misorientation_change < 0 or (temperature > 0 and rng.random() < np.exp(-misorientation_change/temperature)):
+        return misorientation_change
+
+    network.undo()
+
+    return 0
+
+def exchange_probability(energy_i,energy_j,temperature_i,temperature_j):
     """
+    Probability of exchanging the arrangements of two replicas, min(1, exp((E_i - E_j)(1/T_i - 1/T_j))).
+    """
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        exponent = (energy_i-energy_j)*(np.divide(1,temperature_i)-np.divide(1,temperature_j))
+
+    # Equal energies or two zero temperatures
+    if np.isnan(exponent):
+        return 1.0
+
+    return min(1.0,np.exp(exponent))
 
-    shape = material.shape
-
-    neighbour_grains = [set() for grain in np.unique(material)]
-
-    # We start from 1 and end on -1 to prevent catching the boundaries
-    for i in range(1,shape[0]-1):
-        for j in range(1,shape[1]-1):
-            for k in range(1,shape[2]-1):
-
-                centre = material[i,j,k]
-                
-                # We only consider the first nearest neighbours
-                # first order neighbours
-                neighbours = np.array([
-                                       #material[i+1,j,k],material[i-1,j,k],
-                                       #material[i,j+1,k],material[i,j-1,k],
-                                       #material[i,j,k+1],material[i,j,k-1],
-
-                                        material[i-1,j,  k  ], # Close face
-                                        material[i-1,j-1,k  ],
-                                        material[i-1,j+1,k  ],
-                                        material[i-1,j,  k+1],
-                                        material[i-1,j-1,k+1],
-                                        material[i-1,j+1,k+1],
-                                        material[i-1,j,  k-1],
-                                        material[i-1,j-1,k-1],
-                                        material[i-1,j+1,k-1],
-
-                                        #material[i  ,j,  k  ], # Centre face
-                                        material[i  ,j-1,k  ],
-                                        material[i  ,j+1,k  ],
-                                        material[i  ,j,  k+1],
-                                        material[i  ,j-1,k+1],
-                                        material[i  ,j+1,k+1],
-                                        material[i  ,j,  k-1],
-                                        material[i  ,j-1,k-1],
-                                        material[i  ,j+1,k-1],
-
-                                        material[i+1,j,  k  ], # Far face
-                                        material[i+1,j-1,k  ],
-                                        material[i+1,j+1,k  ],
-                                        material[i+1,j,  k+1],
-                                        material[i+1,j-1,k+1],
-                                        material[i+1,j+1,k+1],
-                                        material[i+1,j,  k-1],
-                                        material[i+1,j-1,k-1],
-                                        material[i+1,j+1,k-1],
-                                       ])
-
-                neighbours = np.unique(neighbours).tolist()
-
-                neighbour_grains[centre].update(neighbours)
-
-                if centre in neighbours:
-                    neighbour_grains[centre].remove(centre) # Make sure to remove the centre as this is the self ID
-
-    neighbour_grains = [list(grain) for grain in neighbour_grains]
-
-    return neighbour_grains
-
-def choose(minimum,maximum,exclusions):
+def choose_independent_pairs(indptr,indices,pairs,size=None):
     """
-    Function to sample from a flat distribution with exclusions.
+    Function to select candidate swaps that can be evaluated independently.
+
+    Candidates are taken in order and kept when neither grain is one of, or a
+    neighbour of, the grains of a kept swap. The kept swaps then touch disjoint
+    sets of grain boundaries and their mean local misorientations do not depend
+    on each other.
 
     Parameters
     ----------
-    minimum : int
-        Minimum value of the distribution.
-    maximum : int
-        Maximum value of the distribution.
-    exclusions : list
-        List of values to exclude from the distribution.
+    indptr,indices : array
+        Grain adjacency, see find_neighbour_grains.
+    pairs : array (:,2)
+        Candidate swaps, see choose_pairs.
+    size : int or None
+        Largest number of swaps to keep.
 
     Returns
     -------
-    choice : int
-        Chosen value from the distribution.
+    pairs : array (:,2)
+        Kept swaps in the order they were drawn.
     """
 
-    choice = random.choice([i for i in range(minimum,maximum) if i not in exclusions])
+    blocked = np.zeros(len(indptr)-1,dtype=bool)
+    selected = []
+
+    for k,(i,j) in enumerate(pairs.tolist()):
+
+        if blocked[i] or blocked[j]:
+            continue
+
+        # Block the closed neighbourhoods of both grains
+        blocked[[i,j]] = True
+        blocked[indices[indptr[i]:indptr[i+1]]] = True
+        blocked[indices[indptr[j]:indptr[j+1]]] = True
+
+        selected.append(k)
 
-    return choice
+        if len(selected) == size:
+            break
 
-def switch(x,locations):
+    return pairs[selected]
+
+def choose_pairs(eligible,size,rng=None):
     """
-    Function to switch rows in a list.
+    Function to sample pairs of grains from a flat distribution.
 
     Parameters
     ----------
-    x : list
-        List of values.
-    locations : list of int of length (2)
-        Two indices to swap.
+    eligible : array
+        Grain indices that may be chosen.
+    size : int
+        Number of pairs to draw.
+    rng : np.random.Generator or None
+        Random number generator. Defaults to the global numpy state.
 
     Returns
     -------
-    x_new : list
-        List of values with a switch.
+    pairs : array (size,2)
+        Chosen grain indices.
     """
-    
-    i,j = locations
-    
-    x_new = copy.copy(x)
 
-    x_new[[j,i]] = x_new[[i,j]] 
-    
-    return x_new
+    rng = np.random if rng is None else rng
 
+    return eligible[(rng.random(size=(size,2))*len(eligible)).astype(int)]
@@ -1,6 +1,7 @@
 from subsurface.imports import *
 from subsurface.tools import *
 from subsurface.construction import *
+from subsurface.vti import write_vti
 
 class Voronoi:
     def __init__(self,
@@ -22,7 +23,8 @@ class Voronoi:
         seeds : list[list[float]] 
             Seed locations relative to origin in [m].
         clusters : list[list[float]] 
-            Cluster locations relative to the origin in [m].
+            Cluster locations relative to the origin in [m]. A list of these
+            from the finest to the coarsest level clusters hierarchically.
         size : sequence of floats with length of (3)
             Size in [m] of the edge lengths of the RVE.
         """ 
@@ -33,6 +35,8 @@ class Voronoi:
         self.periodic = periodic
         self.minkowski = minkowski
         self.clusters = clusters
+        self.matrix = None
+        self._updated_voxels = None
 
     def __str__(self):
 
@@ -85,17 +89,21 @@ class Voronoi:
               seeds: list[list[float]],
               ):
         self._seeds = np.asarray(seeds)
+        self._grain_statistics = None
 
     @property
-    def clusters(self) -> np.ndarray:
-        """Cluster locations in [m]."""
+    def clusters(self) -> np.ndarray | list[np.ndarray]:
+        """Cluster locations in [m], or a list of them from the finest to the coarsest level."""
         return self._clusters
     
     @clusters.setter
     def clusters(self,
-              clusters: list[list[float]],
+              clusters: list[list[float]] | list[list[list[float]]],
               ):
-        self._clusters = np.asarray(clusters)
+        if isinstance(clusters,(list,tuple)) and len(clusters) > 0 and np.ndim(clusters[0]) == 2:
+            self._clusters = [np.asarray(level) for level in clusters]
+        else:
+            self._clusters = np.asarray(clusters)
 
     @property
     def origin(self) -> np.ndarray:
@@ -120,6 +128,7 @@ class Voronoi:
                  periodic: bool,
                  ):
         self._periodic = periodic
+        self._grain_statistics = None
     
     @property
     def minkowski(self) -> float:
@@ -134,84 +143,391 @@ class Voronoi:
 
     @property
     def coordinates(self) -> np.ndarray:
-        """Coordinates of the tesselation grid."""
-        return self._coordinates
-    
-    @coordinates.setter
-    def coordinates(self,
-                coordinates):
-        self._coordinates = coordinates
+        """Coordinates of the tesselation grid, generated on each access."""
+        return get_grid_coordinates(get_grid_axes(self._origin,self._size,self._voxels))
 
     @property
     def matrix(self) -> np.ndarray:
-        """The Voronoi tesselation grid."""
+        """The Voronoi tesselation grid, generated on first access."""
+        if self._matrix is None:
+            self.generate_matrix()
         return self._matrix
     
     @matrix.setter
     def matrix(self,
                 matrix):
         self._matrix = matrix
+        self._margin = None
+        self._grain_statistics = None
+        self._seed_matrix = None
+        self._cluster_map = None
+
+    @property
+    def seed_matrix(self) -> np.ndarray:
+        """The tesselation grid of seed indices, kept when the grid is clustered."""
+        return self.matrix if self._seed_matrix is None else self._seed_matrix
+
+    @property
+    def cluster_map(self) -> list[np.ndarray] | None:
+        """Lookup tables from seed index to cluster index for each cluster level."""
+        return self._cluster_map
+
+    @property
+    def margin(self) -> np.ndarray | None:
+        """Second nearest seed of each voxel and its gaps to the second and third nearest seed, see generate_matrix."""
+        return self._margin
+
+    @margin.setter
+    def margin(self,
+               margin):
+        self._margin = margin
+
+    @property
+    def updated_voxels(self) -> int | None:
+        """Number of voxels queried again by the last update_matrix."""
+        return self._updated_voxels
 
     # Derived inputs
     @property
     def surface(self):
         """The surface of the Voronoi tesselation"""
-        self._surface = get_voronoi_surface(self._matrix)
+        self._surface = get_voronoi_surface(self.matrix)
         return self._surface
 
     @property
-    def grain_centre(self):
-        """The centre of each generated grain."""
-        seed_values = np.unique(self.matrix)
-        self._grain_centre = get_grain_centre(self._matrix,self._seeds,seed_values,self._size,self._voxels)
-        return self._grain_centre
+    def grain_centre(self) -> np.ndarray:
+        """The centre of each generated grain, kept whole across the faces of a periodic tesselation."""
+        return get_grain_centre(self.matrix,self._seeds,None,self._size,self._voxels,self._get_grain_statistics())
+
+    @property
+    def grain_volume(self) -> np.ndarray:
+        """The volume of each generated grain in [m^3]."""
+        return self._get_grain_statistics()['count']*np.prod(self._size/self._voxels)
+
+    @property
+    def grain_bounds(self) -> np.ndarray:
+        """Inclusive lower and upper voxel indices bounding each grain, -1 for grains without voxels."""
+        statistics = self._get_grain_statistics()
+        return np.stack([statistics['lower'],statistics['upper']],axis=1)
+
+    def _get_grain_statistics(self):
+        """Grain statistics of the matrix, computed once until the matrix or seeds change."""
+        if self._grain_statistics is None:
+            self._grain_statistics = get_grain_statistics(self.matrix,len(self._seeds),self._periodic)
+        return self._grain_statistics
 
     def generate_coordinates(self):
-        """Generate the coordinates of the tesselation grid."""
-        
-        start = self._origin              + self._size/self._voxels*0.5 # Add voxel centre offset
-        end = self._origin + self._size   - self._size/self._voxels*0.5 # Add voxel offset
-    
-        self._coordinates = np.stack(np.meshgrid(np.linspace(start[0],end[0],self._voxels[0]),
-                                           np.linspace(start[1],end[1],self._voxels[1]),
-                                           np.linspace(start[2],end[2],self._voxels[2]),
-                                           indexing='ij'),
-                                           axis=-1)
+        """
+        Generate the coordinates of the tesselation grid.
+
+        The voxel centres are generated on the fly while the grid is queried, so
+        nothing is stored. Use the coordinates property to materialise them.
+        """
+        return self
+
+    def generate_matrix(self,workers=8,chunk_size=2**20,memory=None,out=None,margin=False):
+        """
+        Generate the values of the tesselation grid.
+
+        The grid is processed in tiles of whole x slabs, or of y rows within a slab
+        when a single slab is too large, so the voxel centres and query results are
+        never all held at once.
+
+        Parameters
+        ----------
+        workers : int
+            Number of threads used to query the seeds of each tile.
+        chunk_size : int
+            Number of voxels in each tile, halved when the margin is stored.
+        memory : float | None
+            Approximate memory budget for each tile in bytes. Overrides chunk_size.
+        out : array-like | None
+            Preallocated array of shape voxels to write the values into, such as
+            an np.memmap or h5py dataset from allocate_matrix. Defaults to an
+            array in memory of the smallest sufficient unsigned dtype.
+        margin : bool | array-like
+            Whether to store the margin used by update_matrix, the second nearest
+            seed of each voxel and its gaps to the second and third nearest seed.
+            It takes a deeper query and 10 bytes per voxel for up to 65536 seeds,
+            so only the grids that are updated need it. A preallocated array from
+            allocate_matrix(margin=True), such as an h5py dataset, stores it there.
+            Defaults to false.
+        """
+
+        if margin is True:
+            margin = self.allocate_matrix(margin=True)
+
+        elif margin is False:
+            margin = None
+
+        # Coordinates, their meshgrid and the query results per voxel
+        bytes_per_voxel = 64 if margin is None else 128
+
+        if memory is not None:
+            chunk_size = int(memory//bytes_per_voxel)
+
+        elif margin is not None:
+            chunk_size = max(1,chunk_size//2)
+
+        seed_tree = scipy.spatial.KDTree(self._seeds,boxsize=self._size if self._periodic else None)
+
+        axes = get_grid_axes(self._origin,self._size,self._voxels)
+
+        matrix = self.allocate_matrix() if out is None else out
+        margin_dtype = get_margin_dtype(len(self._seeds))
+
+        for x,y in get_grid_tiles(self._voxels,chunk_size):
+
+            coordinates = get_grid_coordinates(axes,x=x,y=y)
+
+            if margin is not None:
+                shape = coordinates.shape[:-1]
+
+                distance,index = seed_tree.query(coordinates.reshape(-1,3),k=3,workers=workers,p=self._minkowski)
+                del coordinates
+
+                matrix[x,y] = index[:,0].reshape(shape)
+                margin[x,y] = get_seed_margin(distance,index,margin_dtype).reshape(shape)
+
+            else:
+                index = seed_tree.query(coordinates.reshape(-1,3),workers=workers,p=self._minkowski)[1]
+
+                matrix[x,y] = index.reshape(coordinates.shape[:-1])
+
+        self.matrix = matrix
+        self.margin = margin
+
         return self
 
-    def generate_matrix(self,workers=8):
-        """Generate the values of the tesselation grid."""
+    def allocate_matrix(self,filename=None,dataset=None,margin=False):
+        """
+        Allocate a tesselation grid in the smallest unsigned dtype that holds every seed index.
+
+        Parameters
+        ----------
+        filename : str | h5py.Group | None
+            File to back the grid with as an np.memmap, or an open HDF5 file or
+            group to create a dataset in. The caller keeps the HDF5 file and
+            closes it. Defaults to an array in memory.
+        dataset : str | None
+            Name of the HDF5 dataset to create in filename.
+        margin : bool
+            Allocate the margin of generate_matrix(margin=True) instead of the grid,
+            to back both the same way.
+
+        Returns
+        -------
+        matrix : np.ndarray | np.memmap | h5py.Dataset
+            Uninitialised grid of shape voxels.
+        """
+        dtype = get_margin_dtype(len(self._seeds)) if margin else get_label_dtype(len(self._seeds))
+        shape = tuple(int(n) for n in self._voxels)
+
+        if filename is None:
+            return np.empty(shape,dtype=dtype)
+
+        if dataset is None:
+            return np.memmap(filename,dtype=dtype,mode='w+',shape=shape)
+
+        if isinstance(filename,(str,os.PathLike)):
+            raise ValueError('Open the HDF5 file and pass it as filename, so it can be closed once the grid is used.')
+
+        # Chunks of whole x slabs, as the grid is generated and updated in tiles of them
+        return filename.create_dataset(dataset,shape=shape,dtype=dtype,chunks=(1,*shape[1:]))
+
+    def generate_layer(self,layer=0,workers=8):
+        """
+        Generate the values of a single z layer of the tesselation grid.
+
+        Only the voxels in the layer are queried and the matrix is left untouched.
+
+        Parameters
+        ----------
+        layer : int
+            Index of the layer along the z direction.
+
+        Returns
+        -------
+        layer_matrix : np.ndarray (:,:)
+            Seed index of each voxel in the layer, in the dtype of the matrix.
+        """
+        coordinates = get_grid_coordinates(get_grid_axes(self._origin,self._size,self._voxels),z=layer)
+
+        seed_tree = scipy.spatial.KDTree(self._seeds,boxsize=self._size if self._periodic else None)
+
+        layer_matrix = seed_tree.query(coordinates.reshape(-1,coordinates.shape[-1]),workers=workers,p=self._minkowski)[1]
+
+        return layer_matrix.reshape(coordinates.shape[:2]).astype(get_label_dtype(len(self._seeds)))
+
+    def update_matrix(self,old_seeds,new_seeds,workers=8,out=None,chunk_size=2**20):
+        """
+        Update the values of the tesselation grid after the seeds have moved.
+
+        A voxel can only change owner if the gap to its second nearest seed is no larger
+        than the displacement of its own seed plus the largest seed displacement, so every
+        other voxel is copied. Of those that can change, the ones with a larger gap to
+        their third nearest seed are settled between their two nearest seeds directly,
+        and only the rest are queried again. The result is identical to calling
+        generate_matrix with the new seeds. The grid is processed in tiles like
+        generate_matrix.
+
+        The margin from generate_matrix(margin=True) is needed, otherwise the whole grid
+        is generated again. The updated grid has no margin, so update repeatedly from the
+        same generated grid to keep every update incremental.
+
+        Parameters
+        ----------
+        old_seeds : list[list[float]]
+            Seed locations the current matrix and margin were generated from in [m].
+        new_seeds : list[list[float]]
+            New seed locations in [m].
+        out : array-like | None
+            Preallocated array, such as an np.memmap or h5py dataset from
+            allocate_matrix, to write the updated grid into. Defaults to a new
+            array in memory.
+        chunk_size : int
+            Number of voxels in each tile.
+        """
+        old_seeds = np.asarray(old_seeds)
+        new_seeds = np.asarray(new_seeds)
+
+        matrix = self._matrix
+        margin = self._margin
+
+        self.seeds = new_seeds
+
+        # Without a margin from a previous generation the whole grid must be rebuilt
+        if margin is None or old_seeds.shape != new_seeds.shape:
+            self._updated_voxels = int(np.prod(self._voxels))
+            return self.generate_matrix(workers=workers,out=out)
+
+        displacement = new_seeds - old_seeds
+
+        if self._periodic:
+            displacement = displacement - self._size*np.round(displacement/self._size)
+
+        if not np.any(displacement) and out is None:
+            self._updated_voxels = 0
+            return self
+
+        distance = np.linalg.norm(displacement,ord=self._minkowski,axis=1)
+
+        # Rounding slack of the stored gaps and of the distances compared directly
+        tolerance = np.finfo(np.float32).eps*np.max(self._size)
+
+        # Largest gap the voxels of each seed can lose, rounded up so it stays an upper bound
+        shift = np.nextafter((distance + np.max(distance) + tolerance).astype(np.float32),np.float32(np.inf))
 
         seed_tree = scipy.spatial.KDTree(self._seeds,boxsize=self._size if self._periodic else None)
 
-        matrix = seed_tree.query(self._coordinates.reshape(-1,self._coordinates.shape[-1]), workers=workers,p=self._minkowski)[1]
-         
-        self.matrix = matrix.reshape(self._coordinates.shape[:-1])
+        axes = get_grid_axes(self._origin,self._size,self._voxels)
+
+        updated_matrix = self.allocate_matrix() if out is None else out
+        updated_voxels = 0
+
+        for x,y in get_grid_tiles(self._voxels,chunk_size):
+
+            labels = np.array(matrix[x,y])
+            tile_margin = np.asarray(margin[x,y]).reshape(-1)
+
+            tile_labels = labels.reshape(-1)
+            tile_shift = shift[tile_labels]
+
+            candidates = np.flatnonzero(tile_margin['gap'][:,0] <= tile_shift)
+
+            if len(candidates) > 0:
+                tile_axes = [axes[0][x],axes[1][y],axes[2]]
+                position = np.unravel_index(candidates,labels.shape)
+
+                owner = tile_labels[candidates]
+                second = np.minimum(tile_margin['second'][candidates],len(self._seeds)-1)
+
+                # Without a third seed within reach the new owner is the nearer of the two nearest seeds
+                owner_distance = get_seed_distance(tile_axes,position,self._seeds[owner],self._size,self._periodic,self._minkowski)
+                second_distance = get_seed_distance(tile_axes,position,self._seeds[second],self._size,self._periodic,self._minkowski)
+
+                tile_labels[candidates] = np.where(second_distance < owner_distance,second,owner)
+
+                query = np.abs(second_distance-owner_distance) <= tolerance
+                query |= tile_margin['gap'][candidates,1] <= tile_shift[candidates]
+
+                if np.any(query):
+                    coordinates = np.stack([axis[i][query] for axis,i in zip(tile_axes,position)],axis=-1)
+
+                    tile_labels[candidates[query]] = seed_tree.query(coordinates,workers=workers,p=self._minkowski)[1]
+
+                updated_voxels += np.count_nonzero(query)
+
+            updated_matrix[x,y] = labels
+
+        self.matrix = updated_matrix
+        self._updated_voxels = updated_voxels
 
         return self
 
     def generate_clusters(self,workers=4):
-        """Cluster the Voronoi cells in the tesselation."""
+        """
+        Cluster the Voronoi cells in the tesselation.
+
+        Every seed is assigned to its nearest cluster, and with several cluster
+        levels every cluster to its nearest cluster of the next level. The
+        matrix is relabelled to the coarsest level through a lookup table while
+        the seed level grid stays available as seed_matrix.
+        """
+
+        levels = self._clusters if isinstance(self._clusters,list) else [self._clusters]
+
+        cluster_map = []
+        points = self._seeds
+
+        for clusters in levels:
 
-        cluster_tree = scipy.spatial.KDTree(self._clusters,boxsize=self._size if self._periodic else None)
+            cluster_tree = scipy.spatial.KDTree(clusters,boxsize=self._size if self._periodic else None)
 
-        seed_cluster = cluster_tree.query(self._seeds,workers=workers)[1]
+            point_cluster = cluster_tree.query(points,workers=workers)[1].astype(get_label_dtype(len(clusters)))
 
-        cluster_dict = dict(zip(range(len(self._seeds)),seed_cluster))
+            # Compose with the previous levels to map seeds directly to this level
+            cluster_map.append(point_cluster if not cluster_map else point_cluster[cluster_map[-1]])
 
-        self.matrix = np.vectorize(lambda x: cluster_dict[x])(self.matrix)
+            points = clusters
+
+        seed_matrix = self.seed_matrix
+
+        self.matrix = cluster_map[-1][seed_matrix]
+
+        self._seed_matrix = seed_matrix
+        self._cluster_map = cluster_map
 
         return self
 
-    def save(self,filename):
-        """Save the tesselation as a VTI."""
+    def cluster_matrix(self,level=-1):
+        """
+        Tesselation grid of cluster indices at a given level.
 
-        # Generate a dummy grid using damask
-        grid = damask.GeomGrid.from_Voronoi_tessellation(size=[1,1,1],seeds=[[1,1,1]],cells=[1,1,1],periodic=False)
-        
-        grid.size = self._size
-        grid.material = self._matrix
-        grid.save(fname=filename)
+        Parameters
+        ----------
+        level : int
+            Cluster level, counted from the finest. Defaults to the coarsest.
+        """
+        return self._cluster_map[level][self.seed_matrix]
+
+    def save(self,filename,cell_data=None,compression_level=1,dtype=None):
+        """
+        Save the tesselation as a VTI that damask.GeomGrid.load reads.
+
+        Parameters
+        ----------
+        filename : str
+            Path of the file, '.vti' is appended when missing.
+        cell_data : dict or None
+            Per-grain arrays to write for every cell. damask reads scalars and
+            three component arrays, such as Euler angles, as initial conditions.
+        compression_level : int or None
+            zlib compression level, None to write uncompressed data.
+        dtype : numpy dtype or None
+            Type of the labels, see subsurface.vti.write_vti.
+        """
+        write_vti(filename,self.matrix,self._size,self._origin,cell_data,dtype,compression_level)
 
         return self
 
@@ -219,7 +535,8 @@ class Voronoi:
     def perturb_seed_locations(self,
                                scale: float,
                                bounded: bool = False,
-                               weights: np.ndarray| None = None
+                               weights: np.ndarray| None = None,
+                               rng: np.random.Generator | None = None,
                                ) -> np.ndarray:
         """
 
@@ -230,6 +547,7 @@ class Voronoi:
             scale (float): Width the perturbation distribution in [m]. 
             bounded (bool, optional): Whether to use periodic boundary conditions when perturbing. Defaults to False.
             weights (np.ndarray | None, optional): Weight of the x,y,z pertuburbation for each seed. Defaults to None.
+            rng (np.random.Generator | None, optional): Random number generator to draw from. Defaults to the global numpy state.
 
         Returns:
             perturbed_seeds (np.ndarray): New seed locations in [m].
@@ -239,11 +557,13 @@ class Voronoi:
 
         weights = weights if weights is not None else np.ones(self._seeds.shape)
 
-        perturbation = 2*(np.random.random(size=(self._seeds.shape))-0.5)*scale
+        rng = np.random if rng is None else rng
+
+        perturbation = 2*(rng.random(size=(self._seeds.shape))-0.5)*scale
 
-        self._seeds = self._seeds + perturbation*weights
+        self.seeds = self._seeds + perturbation*weights
 
         if bounded==True:
-            self._seeds = np.mod(self._seeds,self._size)
+            self.seeds = np.mod(self._seeds,self._size)
 
         return self._seeds
\ No newline at end of file
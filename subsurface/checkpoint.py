@@ -0,0 +1,221 @@
+"""
+Periodic checkpoints of long running chains in HDF5 files.
+"""
+import os
+import json
+import time
+import numpy as np
+
+
+class Checkpoint:
+    def __init__(self,
+                 filename: str,
+                 interval: float = 300.0,
+                 resume: bool = False,
+                 ):
+        """
+        Writer of checkpoints to an HDF5 file and a history file next to it.
+
+        The state of the run is small and is written in full to a temporary
+        file next to the checkpoint, which then replaces it, so an interrupted
+        write never corrupts the last complete checkpoint. Arrays that do not
+        change are written to the history file once, and outputs that only grow
+        are appended to resizable datasets in it. The state records how many
+        rows of every output belong to the checkpoint, so rows appended by an
+        interrupted checkpoint are ignored and overwritten.
+
+        Parameters
+        ----------
+        filename : str
+            Path of the checkpoint file, the history is stored as filename + '.history'.
+        interval : float
+            Wall time in seconds between checkpoints.
+        resume : bool
+            Continue the checkpoint written by an earlier run rather than start a new one.
+        """
+        self.filename = filename
+        self.history = filename + '.history'
+        self.interval = interval
+
+        self._lengths = None
+
+        if resume:
+            import h5py
+
+            with h5py.File(filename,'r') as file:
+                self._lengths = decode(file.attrs['lengths'])
+
+        self._last = time.monotonic()
+
+    def due(self) -> bool:
+        """Whether interval seconds have passed since the last checkpoint."""
+        return time.monotonic() - self._last >= self.interval
+
+    def written(self,name) -> int:
+        """Number of rows of an output stored by the last checkpoint."""
+        return 0 if self._lengths is None else self._lengths.get(name,0)
+
+    def save(self,arrays,attributes,constant=None,append=None):
+        """
+        Write a checkpoint.
+
+        Parameters
+        ----------
+        arrays : dict
+            Arrays of the state to store, keyed by their path in the file.
+        attributes : dict
+            Values to store as JSON, see encode.
+        constant : dict or None
+            Arrays that do not change during the run, only stored by the first checkpoint.
+        append : dict or None
+            Rows of the outputs emitted since the last checkpoint, see written.
+        """
+        import h5py
+
+        if self._lengths is None:
+
+            # A new run must not pair a stale state with its history
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+            with h5py.File(self.history,'w') as file:
+                for name,array in (constant or {}).items():
+                    file.create_dataset(name,data=np.asarray(array))
+
+            self._lengths = {}
+
+        lengths = dict(self._lengths)
+
+        with h5py.File(self.history,'a') as file:
+
+            for name,rows in (append or {}).items():
+
+                rows = np.asarray(rows)
+                length = lengths.get(name,0)
+
+                if name not in file:
+                    file.create_dataset(name,shape=(0,)+rows.shape[1:],dtype=rows.dtype,maxshape=(None,)+rows.shape[1:],chunks=True)
+
+                file[name].resize(length+len(rows),axis=0)
+                file[name][length:] = rows
+
+                lengths[name] = length+len(rows)
+
+        temporary = self.filename + '.tmp'
+
+        with h5py.File(temporary,'w') as file:
+
+            for name,array in arrays.items():
+                file.create_dataset(name,data=np.asarray(array))
+
+            for name,value in attributes.items():
+                file.attrs[name] = encode(value)
+
+            file.attrs['lengths'] = encode(lengths)
+
+        os.replace(temporary,self.filename)
+
+        self._lengths = lengths
+        self._last = time.monotonic()
+
+
+def load_checkpoint(filename):
+    """
+    Read a checkpoint written by Checkpoint.save.
+
+    Returns
+    -------
+    arrays : dict
+        Stored arrays of the state and the history keyed by their path in the file,
+        outputs hold the rows stored by the checkpoint.
+    attributes : dict
+        Stored values decoded from JSON.
+    """
+    import h5py
+
+    arrays = {}
+
+    with h5py.File(filename,'r') as file:
+
+        file.visititems(lambda name,item: arrays.__setitem__(name,item[()]) if isinstance(item,h5py.Dataset) else None)
+
+        attributes = {name:decode(value) for name,value in file.attrs.items()}
+
+    lengths = attributes.pop('lengths')
+
+    def read(name,item):
+
+        if isinstance(item,h5py.Dataset):
+            arrays[name] = item[:lengths[name]] if name in lengths else item[()]
+
+    with h5py.File(filename + '.history','r') as file:
+        file.visititems(read)
+
+    return arrays,attributes
+
+
+def encode(value):
+    """JSON representation of a value that may contain numpy scalars and arrays."""
+
+    def default(item):
+
+        if isinstance(item,np.ndarray):
+            return {'__ndarray__':item.tolist(),'dtype':item.dtype.str}
+
+        if isinstance(item,np.generic):
+            return item.item()
+
+        raise TypeError(f'Cannot store {type(item).__name__} in a checkpoint')
+
+    return json.dumps(value,default=default)
+
+def decode(value):
+    """Value stored by encode."""
+
+    def hook(item):
+
+        if '__ndarray__' in item:
+            return np.array(item['__ndarray__'],dtype=item['dtype'])
+
+        return item
+
+    return json.loads(value,object_hook=hook)
+
+
+def get_rng_state(rng):
+    """State of a generator, or of the global numpy state when rng is None."""
+
+    if rng is None:
+        return np.random.get_state(legacy=False)
+
+    return rng.bit_generator.state
+
+def set_rng_state(rng,state):
+    """Restore a state from get_rng_state."""
+
+    if rng is None:
+        np.random.set_state(state)
+
+    else:
+        rng.bit_generator.state = state
+
+def restore_rng(state,generator):
+    """
+    Generator restored from a checkpoint.
+
+    Parameters
+    ----------
+    state : dict
+        State from get_rng_state.
+    generator : bool
+        Whether the run drew from a np.random.Generator, otherwise the global numpy state is restored.
+    """
+
+    if not generator:
+        set_rng_state(None,state)
+        return None
+
+    rng = np.random.Generator(getattr(np.random,state['bit_generator'])())
+    set_rng_state(rng,state)
+
+    return rng
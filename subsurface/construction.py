@@ -10,6 +10,73 @@ import math
 # Dervied property calculation
 #--------------------------------------------------
 
+def get_grid_axes(origin,size,voxels):
+
+    start = origin        + size/voxels*0.5 # Add voxel centre offset
+    end = origin + size   - size/voxels*0.5 # Add voxel offset
+
+    return [np.linspace(start[i],end[i],voxels[i]) for i in range(3)]
+
+def get_grid_coordinates(axes,x=slice(None),y=slice(None),z=slice(None)):
+
+    # Voxel centres of a block of the grid with shape (nx,ny,nz,3)
+    return np.stack(np.meshgrid(axes[0][x],axes[1][y],axes[2][z],indexing='ij'),axis=-1)
+
+def get_label_dtype(n_labels):
+
+    # Smallest unsigned integer type that holds labels 0 to n_labels-1
+    return np.min_scalar_type(max(int(n_labels)-1,0))
+
+def get_grid_tiles(voxels,tile_size):
+
+    # Blocks of whole x slabs, or of y rows within a single slab, of at most tile_size voxels
+    rows = max(1,tile_size//voxels[2])
+
+    if rows >= voxels[1]:
+        slabs = rows//voxels[1]
+        return [(slice(i,i+slabs),slice(None)) for i in range(0,voxels[0],slabs)]
+
+    return [(slice(i,i+1),slice(j,j+rows)) for i in range(voxels[0]) for j in range(0,voxels[1],rows)]
+
+def get_margin_dtype(n_labels):
+
+    # Second nearest seed of a voxel and the gaps from its nearest to its second and third nearest seed
+    return np.dtype([('second',get_label_dtype(n_labels)),('gap',np.float32,(2,))])
+
+def get_seed_margin(distance,index,dtype):
+
+    margin = np.empty(len(index),dtype=dtype)
+
+    # Gaps are rounded down so they stay lower bounds, missing neighbours of tiny grids have an infinite gap
+    margin['second'] = np.minimum(index[:,1],np.iinfo(dtype['second']).max)
+
+    gap = margin['gap']
+    np.subtract(distance[:,1:],distance[:,:1],out=gap,casting='same_kind')
+    np.nextafter(gap,np.float32(-np.inf),out=gap)
+
+    return margin
+
+def get_seed_distance(axes,position,seeds,size,periodic,minkowski):
+
+    # Distance from each voxel centre, given by its index along each axis, to its own seed
+    # through the nearest periodic image, accumulated one axis at a time
+    distance = np.zeros(len(seeds))
+
+    for i in range(3):
+        vector = axes[i][position[i]] - seeds[:,i]
+
+        if periodic:
+            vector -= size[i]*np.round(vector/size[i])
+
+        np.abs(vector,out=vector)
+
+        if minkowski == np.inf:
+            np.maximum(distance,vector,out=distance)
+        else:
+            distance += vector**minkowski
+
+    return distance if minkowski == np.inf else distance**(1/minkowski)
+
 def get_voronoi_surface(voronoi_matrix):
 
     shape = voronoi_matrix.shape
@@ -20,20 +87,62 @@ def get_voronoi_surface(voronoi_matrix):
     elif len(shape) == 3:
         return voronoi_matrix[:,:,0]
     
-def get_grain_centre(voronoi_matrix,seed_locations,seed_ID,size,voxels):
+def get_grain_statistics(voronoi_matrix,n_grains,periodic=False):
 
-    grain_centres = []
+    # Voxel count, summed voxel indices and inclusive index bounds of every grain,
+    # accumulated from one label histogram per plane along each axis
+    count = np.zeros(n_grains,dtype=np.int64)
+    moment = np.zeros((n_grains,3))
+    lower = np.full((n_grains,3),-1)
+    upper = np.full((n_grains,3),-1)
 
-    seed_ID = np.linspace(0,len(seed_locations)-1,len(seed_locations)).astype(int)
+    # Periodic grains are also measured from a cut through the middle of the grid, and
+    # the cut with the smaller spread is kept, so grains across the faces stay whole
+    if periodic:
+        cuts = np.array([[0,n//2] for n in voronoi_matrix.shape])
+        moments = np.zeros((2,n_grains,3))
+        squares = np.zeros((2,n_grains,3))
 
-    for ID in seed_ID:
+    for axis in range(3):
+        for index,plane in enumerate(np.moveaxis(voronoi_matrix,axis,0)):
 
-        grain_centre = np.array(np.mean(np.where(voronoi_matrix==ID),axis=1))
+            histogram = np.bincount(plane.ravel(),minlength=n_grains)[:n_grains]
+            present = histogram>0
 
-        if math.isnan(np.sum(grain_centre)):
-            grain_centres.append(seed_locations[ID])
+            moment[:,axis] += index*histogram
+            lower[present & (lower[:,axis]<0),axis] = index
+            upper[present,axis] = index
 
-        else:
-            grain_centres.append(grain_centre*np.divide(size,voxels))
+            if axis == 0:
+                count += histogram
+
+            if periodic:
+                for cut in range(2):
+                    shifted = (index - cuts[axis,cut]) % voronoi_matrix.shape[axis]
+                    moments[cut,:,axis] += shifted*histogram
+                    squares[cut,:,axis] += shifted**2*histogram
+
+    if periodic:
+        with np.errstate(invalid='ignore',divide='ignore'):
+            spread = squares/count[:,None] - (moments/count[:,None])**2
+
+        middle = spread[1] < spread[0]
+
+        # Mean index measured from the middle cut, moved back into the grid
+        wrapped = np.mod(moments[1]/np.maximum(count,1)[:,None] + cuts[:,1],voronoi_matrix.shape)*count[:,None]
+        moment = np.where(middle,wrapped,moment)
+
+    return {'count':count,'moment':moment,'lower':lower,'upper':upper}
+
+def get_grain_centre(voronoi_matrix,seed_locations,seed_ID,size,voxels,statistics=None):
+
+    if statistics is None:
+        statistics = get_grain_statistics(voronoi_matrix,len(seed_locations))
+
+    count = statistics['count'][:,None]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        grain_centre = statistics['moment']/count*np.divide(size,voxels)
 
-    return np.array(grain_centres)
\ No newline at end of file
+    # Grains without any voxels are placed at their seed
+    return np.where(count>0,grain_centre,seed_locations)
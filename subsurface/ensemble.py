@@ -0,0 +1,198 @@
+"""
+Chunked, compressed HDF5 store for ensembles of Voronoi tessellations.
+"""
+import numpy as np
+
+from subsurface._voronoi import Voronoi
+from subsurface.construction import get_label_dtype
+
+
+class Ensemble:
+    def __init__(self,
+                 filename: str,
+                 mode: str = 'a',
+                 compression: str | None = 'gzip',
+                 compression_opts: int | None = 4,
+                 chunk_bytes: int = 2**22,
+                 ):
+        """
+        Store of the label grids, seeds, orientations and metadata of many tessellations in one HDF5 file.
+
+        All members share one grid. Their labels are stored in a single resizable
+        dataset that is chunked per member in slabs along x, so any member can be
+        read without touching the others, and members can be appended while a
+        chain is running.
+
+        Parameters
+        ----------
+        filename : str
+            Path of the HDF5 file.
+        mode : str
+            'r' to read, 'a' to read and append, 'w' to start a new file.
+        compression : str or None
+            HDF5 compression filter of the new datasets, None for no compression.
+        compression_opts : int or None
+            Level of the compression filter.
+        chunk_bytes : int
+            Approximate size of a chunk of the label dataset.
+
+        Examples
+        --------
+        >>> with Ensemble('ensemble.h5','w') as ensemble:
+        ...     for N,voronoi in iter_markov_chain(reference,N_iter,threshold,perturbation):
+        ...         ensemble.append(voronoi,increment=N)
+        """
+        import h5py
+
+        self.file = h5py.File(filename,mode)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunk_bytes = chunk_bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __len__(self):
+        return len(self.file['labels']) if 'labels' in self.file else 0
+
+    def __getitem__(self,index):
+        """Voronoi object of a member with its matrix loaded."""
+        attrs = self.file.attrs
+
+        voronoi = Voronoi(attrs['voxels'],attrs['size'],self.seeds(index),
+                          periodic=bool(attrs['periodic']),origin=attrs['origin'],minkowski=float(attrs['minkowski']))
+        voronoi.matrix = self.matrix(index)
+
+        return voronoi
+
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+    def _create(self,name,shape,dtype,chunks):
+
+        return self.file.create_dataset(name,shape=(0,)+shape,maxshape=(None,)+shape,dtype=dtype,chunks=(1,)+chunks,
+                                        compression=self.compression,compression_opts=self.compression_opts,
+                                        shuffle=self.compression is not None)
+
+    def _initialise(self,voronoi,n_labels,orientations):
+
+        voxels = tuple(int(n) for n in voronoi.voxels)
+        dtype = get_label_dtype(n_labels)
+
+        # Slabs of whole x planes, as allocated by Voronoi.allocate_matrix
+        planes = int(np.clip(self.chunk_bytes//(voxels[1]*voxels[2]*dtype.itemsize),1,voxels[0]))
+
+        self._create('labels',voxels,dtype,(planes,)+voxels[1:])
+        self._create('seeds',voronoi.seeds.shape,float,voronoi.seeds.shape)
+
+        if orientations is not None:
+            self._create('orientations',np.shape(orientations),float,np.shape(orientations))
+
+        self.file.attrs.update(dict(voxels=voronoi.voxels,
+                                    size=voronoi.size,
+                                    origin=voronoi.origin,
+                                    periodic=voronoi.periodic,
+                                    minkowski=voronoi.minkowski))
+
+    def append(self,voronoi,orientations=None,**metadata):
+        """
+        Add a member to the end of the ensemble.
+
+        Parameters
+        ----------
+        voronoi : Voronoi Object
+            Tessellation to store, its matrix is generated if needed.
+        orientations : array (:,4) or None
+            Quaternions of the grain orientations.
+        **metadata
+            Numbers to store with the member, such as the increment it was accepted at.
+            Members without a value hold NaN.
+
+        Returns
+        -------
+        index : int
+            Index of the new member.
+        """
+        matrix = voronoi.matrix
+        n_labels = max(len(voronoi.seeds),int(np.max(matrix))+1)
+
+        if 'labels' not in self.file:
+            self._initialise(voronoi,n_labels,orientations)
+
+        labels = self.file['labels']
+        index = len(labels)
+
+        if tuple(matrix.shape) != labels.shape[1:]:
+            raise ValueError(f'Grid {tuple(matrix.shape)} does not match the ensemble grid {labels.shape[1:]}')
+
+        if n_labels > np.iinfo(labels.dtype).max+1:
+            raise ValueError(f'{n_labels} labels do not fit the ensemble label type {labels.dtype}')
+
+        if self.file['seeds'].shape[1:] != voronoi.seeds.shape:
+            raise ValueError(f'Seeds {voronoi.seeds.shape} do not match the ensemble seeds {self.file["seeds"].shape[1:]}')
+
+        if (orientations is None) != ('orientations' not in self.file):
+            raise ValueError('Either every member or no member of the ensemble has orientations')
+
+        labels.resize(index+1,axis=0)
+
+        # Copy slab by slab, so memory mapped and HDF5 grids are never loaded whole
+        planes = labels.chunks[1]
+
+        for x in range(0,labels.shape[1],planes):
+            labels[index,x:x+planes] = np.asarray(matrix[x:x+planes]).astype(labels.dtype)
+
+        for name,value in [('seeds',voronoi.seeds),('orientations',orientations)]:
+            if value is not None:
+                self.file[name].resize(index+1,axis=0)
+                self.file[name][index] = value
+
+        group = self.file.require_group('metadata')
+
+        for name in set(group.keys()) | set(metadata.keys()):
+
+            if name not in group:
+                group.create_dataset(name,shape=(index,),maxshape=(None,),dtype=float,fillvalue=np.nan)
+
+            group[name].resize(index+1,axis=0)
+            group[name][index] = metadata.get(name,np.nan)
+
+        self.file.flush()
+
+        return index
+
+    def extend(self,voronois,orientations=None,**metadata):
+        """
+        Add several members, with optional sequences of orientations and metadata values.
+        """
+        for member,voronoi in enumerate(voronois):
+            self.append(voronoi,
+                        None if orientations is None else orientations[member],
+                        **{name:values[member] for name,values in metadata.items()})
+
+    def matrix(self,index):
+        """Label grid of a member."""
+        return self.file['labels'][index]
+
+    def seeds(self,index):
+        """Seed locations of a member."""
+        return self.file['seeds'][index]
+
+    def orientations(self,index):
+        """Grain orientations of a member, None when the ensemble has none."""
+        return self.file['orientations'][index] if 'orientations' in self.file else None
+
+    def metadata(self,index=None):
+        """
+        Metadata of a member, or of every member as arrays when index is None.
+        """
+        group = self.file.get('metadata',{})
+
+        if index is None:
+            return {name:dataset[()] for name,dataset in group.items()}
+
+        return {name:dataset[index] for name,dataset in group.items()}
@@ -2,12 +2,16 @@ import os
 import scipy
 import numpy as np
 import copy
-import matplotlib.pyplot as plt
-import copy
-import damask
 
-import scienceplots
+# The plotting and damask stacks take seconds to import and are only loaded on first use
+def __getattr__(name):
+
+    if name == 'plt':
+        from subsurface.plotting import use_style
+        return use_style()
+
+    if name == 'damask':
+        import damask
+        return damask
 
-plt.style.use('science')
-plt.rc('text', usetex=False)
-plt.rcParams['figure.dpi'] = 200
\ No newline at end of file
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
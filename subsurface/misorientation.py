@@ -0,0 +1,177 @@
+"""
+Batched disorientation calculations on arrays of quaternions.
+
+Quaternions follow the damask convention (scalar first, P = -1) and the
+angles agree with damask.Orientation.disorientation_angle.
+"""
+import numpy as np
+import collections
+
+# Crystal family of each Bravais lattice
+lattice_families = {'aP':'triclinic',
+                    'mP':'monoclinic','mS':'monoclinic',
+                    'oP':'orthorhombic','oS':'orthorhombic','oI':'orthorhombic','oF':'orthorhombic',
+                    'tP':'tetragonal','tI':'tetragonal',
+                    'hP':'hexagonal',
+                    'cP':'cubic','cI':'cubic','cF':'cubic',
+                    }
+
+# Largest disorientation angle in degrees of each crystal family
+maximum_disorientation = {'triclinic':180.0,
+                          'monoclinic':180.0,
+                          'orthorhombic':120.0,
+                          'tetragonal':98.42,
+                          'hexagonal':93.84,
+                          'cubic':62.80,
+                          }
+
+
+def symmetry_operators(lattice):
+    """
+    Function to find the rotational symmetry operators of a lattice.
+
+    Parameters
+    ----------
+    lattice : str
+        Bravais lattice - see damask.Orientation for full description.
+
+    Returns
+    -------
+    operators : array (:,4)
+        Quaternions of the symmetry operators, 24 for cubic and 12 for hexagonal lattices.
+    """
+    import damask
+
+    return damask.Crystal(family=lattice_families[lattice]).symmetry_operations.as_quaternion()
+
+
+def disorientation_angle(q_a,q_b,operators):
+    """
+    Function to calculate the disorientation angle between pairs of orientations.
+
+    The misorientation of every pair is combined with all symmetry operators in
+    one matrix product, and the operator giving the smallest rotation is kept.
+
+    Parameters
+    ----------
+    q_a : array (...,4)
+        Quaternions of the first orientation of each pair.
+    q_b : array (...,4)
+        Quaternions of the second orientation of each pair, broadcast against q_a.
+    operators : array (:,4)
+        Symmetry operators from symmetry_operators.
+
+    Returns
+    -------
+    omega : array (...)
+        Disorientation angles measured in degrees.
+    """
+
+    q_a = np.asarray(q_a,dtype=float)
+    q_b = np.asarray(q_b,dtype=float)
+
+    a0,a1,a2,a3 = q_a[...,0],q_a[...,1],q_a[...,2],q_a[...,3]
+    b0,b1,b2,b3 = q_b[...,0],q_b[...,1],q_b[...,2],q_b[...,3]
+
+    # Misorientation q_a * ~q_b, written out by component as the batches are often small
+    misorientation = np.stack([a0*b0 + a1*b1 + a2*b2 + a3*b3,
+                               b0*a1 - a0*b1 + a2*b3 - a3*b2,
+                               b0*a2 - a0*b2 + a3*b1 - a1*b3,
+                               b0*a3 - a0*b3 + a1*b2 - a2*b1],axis=-1)
+
+    # Scalar part of the misorientation combined with each symmetry operator, summed in a
+    # fixed order so that every pair gives the same angle whatever batch it is part of
+    m = misorientation[...,None,:]
+
+    trace = np.max(np.abs(m[...,0]*operators[:,0] - m[...,1]*operators[:,1]
+                          - m[...,2]*operators[:,2] - m[...,3]*operators[:,3]),axis=-1)
+
+    return np.degrees(2*np.arccos(np.minimum(trace,1.0)))
+
+
+class DisorientationTable:
+    def __init__(self,
+                 orientations: np.ndarray,
+                 operators: np.ndarray,
+                 dense_limit: int = 2048,
+                 maxsize: int = 2**22,
+                 ):
+        """
+        Memo of disorientation angles between pairs of a fixed set of orientations.
+
+        Pairs are keyed by orientation index, so each angle is only calculated
+        once. Up to dense_limit orientations the angles are held in a dense
+        table, beyond that in a cache that drops the least recently used pairs.
+
+        Parameters
+        ----------
+        orientations : array (:,4)
+            Quaternions of the orientations.
+        operators : array (:,4)
+            Symmetry operators from symmetry_operators.
+        dense_limit : int
+            Largest number of orientations held in a dense table.
+        maxsize : int
+            Number of pairs kept by the least recently used cache.
+        """
+        self.orientations = np.asarray(orientations,dtype=float)
+        self.operators = operators
+        self.maxsize = maxsize
+
+        self.hits = 0
+        self.misses = 0
+
+        n = len(self.orientations)
+
+        self._dense = np.full((n,n),np.nan) if n <= dense_limit else None
+        self._cache = collections.OrderedDict()
+
+    def __call__(self,a,b):
+        """
+        Disorientation angles between orientations a and b in degrees.
+
+        Parameters
+        ----------
+        a : array of int
+            Orientation indices of the first orientation of each pair.
+        b : array of int
+            Orientation indices of the second orientation of each pair.
+        """
+        # Pairs are always calculated from the lower index, so the angle does not depend on the order they are met in
+        a,b = np.minimum(a,b),np.maximum(a,b)
+
+        if self._dense is not None:
+            omega = self._dense[a,b]
+            missing = np.isnan(omega)
+
+        else:
+            key = a*len(self.orientations) + b
+            omega = np.array([self._cache.get(k,np.nan) for k in key.tolist()]).reshape(key.shape)
+            missing = np.isnan(omega)
+
+            for k in key[~missing].tolist():
+                self._cache.move_to_end(k)
+
+        n_missing = int(np.count_nonzero(missing))
+
+        self.misses += n_missing
+        self.hits += omega.size - n_missing
+
+        if n_missing:
+            omega[missing] = disorientation_angle(self.orientations[a[missing]],self.orientations[b[missing]],self.operators)
+
+            if self._dense is not None:
+                self._dense[a[missing],b[missing]] = omega[missing]
+
+            else:
+                self._cache.update(zip(key[missing].tolist(),omega[missing].tolist()))
+
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+
+        return omega
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups answered from the memo."""
+        return self.hits/max(self.hits+self.misses,1)
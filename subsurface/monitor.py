@@ -0,0 +1,149 @@
+"""
+Timings, metrics and progress reporting for long running chains.
+"""
+import sys
+import time
+import collections
+
+
+class Monitor:
+    def __init__(self,
+                 total: int,
+                 callback=None,
+                 frequency: int = 100,
+                 interval: float | None = 1.0,
+                 label: str = 'Searching',
+                 stream=None,
+                 ):
+        """
+        Per stage timings and throttled progress of an iterative run.
+
+        The run marks the start of every stage with stage, which also ends the
+        previous one, and reports the end of every iteration with update. The
+        callback receives the metrics every frequency iterations, and a progress
+        line is written at most once every interval seconds. Without a callback
+        and progress nothing is timed, and due tells the run when metrics that
+        are costly to compute are reported at all.
+
+        Parameters
+        ----------
+        total : int
+            Number of iterations of the run.
+        callback : callable or None
+            Function called with a dictionary of metrics, see metrics.
+        frequency : int
+            Number of iterations between calls of the callback.
+        interval : float or None
+            Wall time in seconds between progress lines, None for no output.
+        label : str
+            Description of the run at the start of the progress line.
+        stream : file or None
+            Stream to write the progress to. Defaults to sys.stdout.
+        """
+        self.total = total
+        self.callback = callback
+        self.frequency = frequency
+        self.interval = interval
+        self.label = label
+        self.stream = sys.stdout if stream is None else stream
+        self.active = callback is not None or interval is not None
+
+        self.timings = collections.defaultdict(float)
+        self.started = time.perf_counter()
+
+        self._stage = None
+        self._stage_start = None
+        self._next_report = frequency
+        self._last_print = None
+
+    def stage(self,name):
+        """Start timing a stage, ending the one before it."""
+        if not self.active:
+            return
+
+        now = time.perf_counter()
+
+        if self._stage is not None:
+            self.timings[self._stage] += now - self._stage_start
+
+        self._stage = name
+        self._stage_start = now
+
+    def due(self,iteration):
+        """Whether update reports the iteration to the callback or the progress line."""
+        if not self.active:
+            return False
+
+        last = iteration+1 >= self.total
+
+        if self.callback is not None and (iteration+1 >= self._next_report or last):
+            return True
+
+        return self.interval is not None and (last or self._last_print is None or time.perf_counter() - self._last_print >= self.interval)
+
+    def metrics(self,iteration,**values):
+        """
+        Metrics of the run after an iteration.
+
+        Returns
+        -------
+        metrics : dict
+            The iteration, total, elapsed wall time, cumulative seconds spent in
+            each stage under timings, and the values reported by the run such as
+            the acceptance rate, step size and energy.
+        """
+        return dict(iteration=iteration,
+                    total=self.total,
+                    elapsed=time.perf_counter()-self.started,
+                    timings=dict(self.timings),
+                    **values)
+
+    def update(self,iteration,acceptance_rate=None,step=None,energy=None,**values):
+        """
+        Report the end of an iteration.
+
+        Parameters
+        ----------
+        iteration : int
+            Index of the iteration that finished.
+        acceptance_rate : float or None
+            Fraction of recent proposals that were accepted.
+        step : float or None
+            Current perturbation or step size.
+        energy : float or None
+            Current value of the objective.
+        **values
+            Further metrics passed on to the callback.
+        """
+        self.stage(None)
+
+        if not self.active:
+            return
+
+        last = iteration+1 >= self.total
+
+        if self.callback is not None and (iteration+1 >= self._next_report or last):
+
+            self._next_report = (iteration+1)//self.frequency*self.frequency + self.frequency
+
+            self.callback(self.metrics(iteration,acceptance_rate=acceptance_rate,step=step,energy=energy,**values))
+
+        if self.interval is None:
+            return
+
+        now = time.perf_counter()
+
+        if last or self._last_print is None or now - self._last_print >= self.interval:
+
+            self._last_print = now
+
+            statement = '{label}...{N}/{N_max}'.format(label=self.label,N=iteration,N_max=self.total)
+
+            if acceptance_rate is not None:
+                statement += 'Success Rate..{X}'.format(X=round(float(acceptance_rate),3)).rjust(20,'.')
+            if step is not None:
+                statement += '..' + '{:.4g}'.format(step)
+            if energy is not None:
+                statement += '..' + '{:.6g}'.format(energy)
+
+            print(statement,end='\n' if last else '\r',file=self.stream,flush=True)
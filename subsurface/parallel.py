@@ -0,0 +1,65 @@
+"""
+Shared memory helpers for spreading work over a process pool.
+"""
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def share_array(array):
+    """
+    Copy an array into a new block of shared memory.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        Array to share with the worker processes.
+
+    Returns
+    -------
+    block : shared_memory.SharedMemory
+        The shared memory block, which the caller must close and unlink.
+    descriptor : tuple
+        Picklable (name, shape, dtype) description used by attach_array.
+    """
+    array = np.asarray(array)
+
+    block = shared_memory.SharedMemory(create=True,size=max(array.nbytes,1))
+
+    shared = np.ndarray(array.shape,dtype=array.dtype,buffer=block.buf)
+    shared[...] = array
+
+    return block,(block.name,array.shape,array.dtype)
+
+
+def attach_array(descriptor):
+    """
+    Attach to an array placed in shared memory by share_array.
+
+    Parameters
+    ----------
+    descriptor : tuple
+        The (name, shape, dtype) description returned by share_array.
+
+    Returns
+    -------
+    block : shared_memory.SharedMemory
+        The attached block, which must be kept alive while the array is used.
+    array : np.ndarray
+        Read-only view of the shared array.
+    """
+    name,shape,dtype = descriptor
+
+    block = shared_memory.SharedMemory(name=name)
+
+    array = np.ndarray(shape,dtype=dtype,buffer=block.buf)
+    array.flags.writeable = False
+
+    return block,array
+
+
+def release(blocks):
+    """Close and unlink shared memory blocks created by share_array."""
+
+    for block in blocks:
+        block.close()
+        block.unlink()
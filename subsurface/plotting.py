@@ -1,11 +1,23 @@
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
-import scienceplots
 
-plt.style.use('science')
-plt.rc('text', usetex=False)
-plt.rcParams['figure.dpi'] = 200
+_styled = False
+
+def use_style():
+    """Import matplotlib and apply the package style on first use, returning pyplot."""
+    global _styled
+
+    import matplotlib.pyplot as plt
+
+    if not _styled:
+        import scienceplots
+
+        plt.style.use('science')
+        plt.rc('text', usetex=False)
+        plt.rcParams['figure.dpi'] = 200
+
+        _styled = True
+
+    return plt
 
 def plot_results(outputs,axis_title=None,name=None,bounds=None,colorbar=False,cbar_ticks=None,cmap='coolwarm',interpolation='nearest',fig=None,ax=None):
     """
@@ -23,6 +35,9 @@ def plot_results(outputs,axis_title=None,name=None,bounds=None,colorbar=False,cb
         fig,ax: matplotlib handles for further adjustment of the figure.
     """
 
+    plt = use_style()
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
     if bounds:
         minx=bounds[0]
         maxx=bounds[1]
@@ -1,8 +1,13 @@
 from subsurface.imports import *
+import itertools
 
 def calculate_accuracy(reference_matrix,peturbed_matrix,layer=0):
 
-    accuracy = (reference_matrix[:,:,layer]==peturbed_matrix[:,:,layer])*1
+    # Two dimensional inputs are treated as the layer itself
+    reference_layer = reference_matrix[:,:,layer] if np.ndim(reference_matrix)==3 else reference_matrix
+    peturbed_layer = peturbed_matrix[:,:,layer] if np.ndim(peturbed_matrix)==3 else peturbed_matrix
+
+    accuracy = (reference_layer==peturbed_layer)*1
 
     accuracy = np.sum(accuracy)/np.multiply(*accuracy.shape)
     
@@ -35,105 +40,165 @@ def extract_surfaces(matrix):
     return [matrix[0,:,:],matrix[-1,:,:],matrix[:,0,:],matrix[:,-1,:],matrix[:,:,0],matrix[:,:,-1]]
 
 
-def find_grain_boundary(RVE,boundary_type='slim'):
+def find_grain_boundary(RVE,boundary_type='slim',periodic=False,output='image'):
+    """
+    Function to find the grain boundary pixels of a 2D surface or voxels of a 3D volume.
+
+    Parameters
+    ----------
+    RVE : array
+        Two or three dimensional array of grain labels.
+    boundary_type : str
+        'slim' compares every voxel with the next voxel along each axis, 'thick'
+        with the previous and next voxel.
+    periodic : bool
+        Whether the edges of the array wrap around.
+    output : str
+        'image' for a float array that is 1 on boundaries and nan elsewhere,
+        'mask' for a boolean array or 'index' for an (n, ndim) array of the
+        boundary voxel indices.
+
+    Returns
+    -------
+    boundary : array
+        Grain boundary in the requested output format.
+    """
 
-    shape = RVE.shape
+    RVE = np.asarray(RVE)
 
-    boundary = np.zeros_like(RVE)
+    if boundary_type == 'slim':
+        shifts = [1]
 
-    for i in range(shape[0]-1):
-        for j in range(shape[1]-1):
+    elif boundary_type == 'thick':
+        shifts = [1,-1]
 
-            centre = RVE[i,j]
+    else:
+        raise ValueError(f'Unknown boundary type {boundary_type}.')
 
-            if boundary_type=='thick':
-                neighbours = np.array([RVE[i+1,j],RVE[i-1,j],RVE[i,j+1],RVE[i,j-1]]) # Thick boundary
-            
-            elif boundary_type=='slim':
-                neighbours = np.array([RVE[i+1,j],RVE[i,j+1]]) # Slim boundary
+    boundary = np.zeros(RVE.shape,dtype=bool)
 
-            if np.mean(neighbours) == centre:
-                boundary[i,j] = 0
+    for axis in range(RVE.ndim):
+
+        # Slices of the array and of its neighbours along this axis
+        head = tuple(slice(None,-1) if i==axis else slice(None) for i in range(RVE.ndim))
+        tail = tuple(slice(1,None) if i==axis else slice(None) for i in range(RVE.ndim))
+
+        for shift in shifts:
+
+            if periodic:
+                boundary |= RVE!=np.roll(RVE,-shift,axis=axis)
+
+            elif shift == 1:
+                boundary[head] |= RVE[head]!=RVE[tail]
 
             else:
-                boundary[i,j] = 1
+                boundary[tail] |= RVE[tail]!=RVE[head]
+
+    if output == 'mask':
+        return boundary
 
-    boundary = np.where(boundary==0, np.nan, boundary)
+    elif output == 'index':
+        return np.argwhere(boundary)
 
-    return boundary
+    elif output == 'image':
+        return np.where(boundary,1.0,np.nan)
 
-def find_neighbour_grains(material):
+    raise ValueError(f'Unknown output {output}.')
+
+def find_neighbour_grains(material,periodic=False,connectivity=26,return_counts=False,n_grains=None):
     """
     Function to find the neighbouring grains to grains in a material RVE.
 
+    The label array is compared with shifted views of itself, once per neighbour
+    direction, so every voxel including the outer shell is considered.
+
     Parameters
     ----------
     material : array (:,:,:)
         Three dimensional representative volume element as an array of material points.
+    periodic : bool
+        Whether grains touching across opposite faces of the RVE are neighbours.
+    connectivity : int
+        Voxel neighbourhood to consider: 6 (faces), 18 (faces and edges) or 26 (faces, edges and corners).
+    return_counts : bool
+        Request the number of voxel faces shared by each pair of neighbouring grains.
+    n_grains : int or None
+        Number of grains, larger than every label. Defaults to the largest label plus one.
 
     Returns
     -------
-    neighbour_grains : list
-        List of lists containing the nearest neighbour grains to each grain.
+    indptr : array
+        Offsets into indices, the neighbours of grain i are indices[indptr[i]:indptr[i+1]].
+    indices : array
+        Sorted neighbour grain indices of every grain.
+    counts : array (optional)
+        Number of voxel faces shared with each neighbour in indices. Grains that only
+        touch along edges or corners share no faces.
     """
 
-    shape = material.shape
-
-    neighbour_grains = [set() for grain in np.unique(material)]
-
-    # We start from 1 and end on -1 to prevent catching the boundaries
-    for i in range(1,shape[0]-1):
-        for j in range(1,shape[1]-1):
-            for k in range(1,shape[2]-1):
-
-                centre = material[i,j,k]
-                
-                # We only consider the first nearest neighbours
-                # first order neighbours
-                neighbours = np.array([
-                                       #material[i+1,j,k],material[i-1,j,k],
-                                       #material[i,j+1,k],material[i,j-1,k],
-                                       #material[i,j,k+1],material[i,j,k-1],
-
-                                        material[i-1,j,  k  ], # Close face
-                                        material[i-1,j-1,k  ],
-                                        material[i-1,j+1,k  ],
-                                        material[i-1,j,  k+1],
-                                        material[i-1,j-1,k+1],
-                                        material[i-1,j+1,k+1],
-                                        material[i-1,j,  k-1],
-                                        material[i-1,j-1,k-1],
-                                        material[i-1,j+1,k-1],
-
-                                        #material[i  ,j,  k  ], # Centre face
-                                        material[i  ,j-1,k  ],
-                                        material[i  ,j+1,k  ],
-                                        material[i  ,j,  k+1],
-                                        material[i  ,j-1,k+1],
-                                        material[i  ,j+1,k+1],
-                                        material[i  ,j,  k-1],
-                                        material[i  ,j-1,k-1],
-                                        material[i  ,j+1,k-1],
-
-                                        material[i+1,j,  k  ], # Far face
-                                        material[i+1,j-1,k  ],
-                                        material[i+1,j+1,k  ],
-                                        material[i+1,j,  k+1],
-                                        material[i+1,j-1,k+1],
-                                        material[i+1,j+1,k+1],
-                                        material[i+1,j,  k-1],
-                                        material[i+1,j-1,k-1],
-                                        material[i+1,j+1,k-1],
-                                       ])
-
-                neighbours = np.unique(neighbours).tolist()
-
-                print(centre)
-                neighbour_grains[centre].update(neighbours)
-
-                if centre in neighbours:
-                    neighbour_grains[centre].remove(centre) # Make sure to remove the centre as this is the self ID
-
-    neighbour_grains = [list(grain) for grain in neighbour_grains]
-
-    return neighbour_grains
\ No newline at end of file
+    material = np.asarray(material)
+
+    largest = int(np.max(material))
+
+    n_grains = largest+1 if n_grains is None else n_grains
+
+    # Pairs are encoded with n_grains, smaller values would alias different pairs
+    if n_grains <= largest:
+        raise ValueError(f'n_grains must exceed the largest label {largest}, got {n_grains}.')
+
+    # Half of the neighbour directions, the other half is covered by symmetry
+    reach = {6:1,18:2,26:3}[connectivity]
+
+    directions = [d for d in itertools.product([-1,0,1],repeat=3) if d > (0,0,0) and np.count_nonzero(d) <= reach]
+
+    pairs = []
+    faces = []
+
+    for direction in directions:
+
+        if periodic:
+            centre = material
+            neighbour = np.roll(material,shift=[-d for d in direction],axis=(0,1,2))
+
+        else:
+            centre = material[tuple(slice(1,None) if d<0 else slice(None,-1) if d>0 else slice(None) for d in direction)]
+            neighbour = material[tuple(slice(None,-1) if d<0 else slice(1,None) if d>0 else slice(None) for d in direction)]
+
+        boundary = centre!=neighbour
+
+        a = centre[boundary].astype(np.int64)
+        b = neighbour[boundary].astype(np.int64)
+
+        # Encode each unordered pair of grains as a single integer
+        key = np.minimum(a,b)*n_grains + np.maximum(a,b)
+
+        if np.count_nonzero(direction) == 1:
+            key,count = np.unique(key,return_counts=True)
+            faces.append((key,count))
+
+        else:
+            key = np.unique(key)
+
+        pairs.append(key)
+
+    edges = np.unique(np.concatenate(pairs)) if pairs else np.zeros(0,dtype=np.int64)
+
+    face_count = np.zeros(len(edges),dtype=np.int64)
+
+    for key,count in faces:
+        np.add.at(face_count,np.searchsorted(edges,key),count)
+
+    # Store both directions of every edge sorted by grain
+    source = np.concatenate([edges//n_grains,edges%n_grains])
+    target = np.concatenate([edges%n_grains,edges//n_grains])
+    count = np.concatenate([face_count,face_count])
+
+    order = np.lexsort((target,source))
+
+    indptr = np.concatenate([[0],np.cumsum(np.bincount(source,minlength=n_grains))])
+    indices = target[order]
+
+    if return_counts:
+        return indptr,indices,count[order]
+
+    return indptr,indices
@@ -0,0 +1,152 @@
+"""
+Writer of VTK ImageData (.vti) files with appended binary data.
+"""
+import zlib
+import numpy as np
+
+# VTK names of the numpy types
+vtk_types = {'int8':'Int8','uint8':'UInt8','int16':'Int16','uint16':'UInt16',
+             'int32':'Int32','uint32':'UInt32','int64':'Int64','uint64':'UInt64',
+             'float32':'Float32','float64':'Float64'}
+
+
+def write_vti(filename,matrix,size,origin=(0.0,0.0,0.0),cell_data=None,dtype=None,compression_level=1,memory=2**26):
+    """
+    Function to write a label grid as VTK ImageData that damask.GeomGrid.load reads.
+
+    The labels are stored as the cell data 'material' in appended raw binary form.
+    The grid is written one z plane at a time, and each plane is one block when
+    compressed, so no reordered copy of the whole grid is made.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the file, '.vti' is appended when missing.
+    matrix : array (:,:,:)
+        Label of every cell, an array, memory map or HDF5 dataset.
+    size : sequence of floats with length of (3)
+        Size in [m] of the edge lengths of the grid.
+    origin : sequence of floats with length of (3)
+        Origin of the grid in [m].
+    cell_data : dict or None
+        Arrays of per-label values, such as orientations, written as cell data
+        by looking up the label of every cell. damask only reads scalars and
+        three component arrays.
+    dtype : numpy dtype or None
+        Type to store the labels as. Defaults to the smallest type damask reads,
+        int32 unless the labels need int64.
+    compression_level : int or None
+        zlib compression level, None to write uncompressed data.
+    memory : int
+        Bytes of the grid read at a time from memory maps and HDF5 datasets.
+    """
+
+    filename = str(filename) if str(filename).endswith('.vti') else str(filename)+'.vti'
+
+    voxels = tuple(int(n) for n in matrix.shape)
+    size = np.asarray(size,dtype=float)
+    origin = np.asarray(origin,dtype=float)
+
+    # Range of the labels, read in z slabs like the data itself
+    minimum,maximum = None,None
+
+    for labels in _z_slabs(matrix,memory):
+        minimum = labels.min() if minimum is None else min(minimum,labels.min())
+        maximum = labels.max() if maximum is None else max(maximum,labels.max())
+
+    if dtype is None:
+        dtype = np.int32 if np.iinfo(np.int32).min <= minimum and maximum <= np.iinfo(np.int32).max else np.int64
+
+    arrays = [('material',np.dtype(dtype),1,None,(minimum,maximum))]
+
+    for name,values in (cell_data or {}).items():
+        values = np.asarray(values)
+        arrays.append((name,values.dtype,int(np.prod(values.shape[1:])),values.reshape(len(values),-1),None))
+
+    # Every array is written as one block per z plane, all planes have the same size
+    plane_cells = voxels[0]*voxels[1]
+    plane_bytes = [plane_cells*components*array_dtype.itemsize for _,array_dtype,components,_,_ in arrays]
+
+    if compression_level is None:
+        blocks = [None]*len(arrays)
+        appended = [8 + voxels[2]*nbytes for nbytes in plane_bytes]
+
+    else:
+        # Compressed sizes precede the data, so the compressed planes are kept until written
+        blocks = [[zlib.compress(plane.tobytes(),compression_level) for plane in _z_planes(matrix,memory,array_dtype,values)]
+                  for _,array_dtype,_,values,_ in arrays]
+        appended = [8*(3+len(array_blocks)) + sum(len(block) for block in array_blocks) for array_blocks in blocks]
+
+    offsets = np.cumsum([0]+appended[:-1])
+
+    extent = ' '.join(f'0 {n}' for n in voxels)
+
+    with open(filename,'wb') as file:
+
+        file.write(('<?xml version="1.0"?>\n'
+                    '<VTKFile type="ImageData" version="1.0" byte_order="LittleEndian" header_type="UInt64"'
+                    + (' compressor="vtkZLibDataCompressor"' if compression_level is not None else '') + '>\n'
+                    f'  <ImageData WholeExtent="{extent}" Origin="{" ".join(map(repr,origin.tolist()))}" '
+                    f'Spacing="{" ".join(map(repr,(size/voxels).tolist()))}" Direction="1 0 0 0 1 0 0 0 1">\n'
+                    f'  <Piece Extent="{extent}">\n'
+                    '    <CellData>\n').encode())
+
+        for (name,array_dtype,components,_,value_range),offset in zip(arrays,offsets):
+
+            attributes = f'type="{vtk_types[array_dtype.name]}" Name="{name}"'
+            if components > 1:
+                attributes += f' NumberOfComponents="{components}"'
+            if value_range is not None:
+                attributes += f' RangeMin="{value_range[0]}" RangeMax="{value_range[1]}"'
+
+            file.write(f'      <DataArray {attributes} format="appended" offset="{offset}"/>\n'.encode())
+
+        file.write(('    </CellData>\n'
+                    '  </Piece>\n'
+                    '  </ImageData>\n'
+                    '  <AppendedData encoding="raw">\n'
+                    '   _').encode())
+
+        for (_,array_dtype,_,values,_),nbytes,array_blocks in zip(arrays,plane_bytes,blocks):
+
+            if array_blocks is None:
+                file.write(np.uint64(voxels[2]*nbytes).tobytes())
+
+                for plane in _z_planes(matrix,memory,array_dtype,values):
+                    file.write(plane.tobytes())
+
+            else:
+                # Number of blocks, their uncompressed size, the size of the last one and every compressed size
+                file.write(np.array([len(array_blocks),nbytes,nbytes]+[len(block) for block in array_blocks],dtype=np.uint64).tobytes())
+
+                for block in array_blocks:
+                    file.write(block)
+
+        file.write(('\n'
+                    '  </AppendedData>\n'
+                    '</VTKFile>\n').encode())
+
+    return filename
+
+
+def _z_slabs(matrix,memory):
+
+    # Consecutive z planes of the grid, as many as fit the memory at a time
+    plane_bytes = matrix.shape[0]*matrix.shape[1]*np.dtype(matrix.dtype).itemsize
+    planes = max(1,memory//plane_bytes)
+
+    for z in range(0,matrix.shape[2],planes):
+        yield np.asarray(matrix[:,:,z:z+planes])
+
+def _z_planes(matrix,memory,dtype,values=None):
+
+    # Cells of every z plane in VTK order, with x running fastest
+    for slab in _z_slabs(matrix,memory):
+        for z in range(slab.shape[2]):
+
+            labels = slab[:,:,z].T
+
+            if values is None:
+                yield np.ascontiguousarray(labels,dtype=dtype)
+            else:
+                yield np.ascontiguousarray(values[labels])
@@ -0,0 +1,589 @@
+import numpy as np
+
+from subsurface import Voronoi
+
+
+def get_voronoi(periodic=False,minkowski=2.0,seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    size = np.array([1.0,0.8,0.6])
+
+    return Voronoi([24,20,16],size,rng.random((60,3))*size,periodic=periodic,minkowski=minkowski)
+
+
+def test_update_matrix_matches_generate_matrix():
+
+    for periodic,minkowski in [(False,2.0),(True,2.0),(False,1.0)]:
+
+        voronoi = get_voronoi(periodic,minkowski)
+
+        rng = np.random.default_rng(1)
+
+        for scale in [0.001,0.01,0.05,0.2]:
+
+            seeds = voronoi.seeds + 2*(rng.random(voronoi.seeds.shape)-0.5)*scale
+
+            if periodic:
+                seeds = np.mod(seeds,voronoi.size)
+
+            updated = get_voronoi(periodic,minkowski).generate_matrix(margin=True)
+            updated.update_matrix(updated.seeds,seeds,chunk_size=1000)
+
+            expected = get_voronoi(periodic,minkowski)
+            expected.seeds = seeds
+
+            assert np.array_equal(updated.matrix,expected.generate_matrix().matrix)
+            assert updated.updated_voxels < updated.matrix.size or scale == 0.2
+
+
+def test_update_matrix_without_margin_generates_matrix():
+
+    voronoi = get_voronoi().generate_matrix()
+
+    seeds = voronoi.seeds + 0.01
+
+    expected = get_voronoi()
+    expected.seeds = seeds
+
+    assert np.array_equal(voronoi.update_matrix(voronoi.seeds,seeds).matrix,expected.generate_matrix().matrix)
+    assert voronoi.updated_voxels == voronoi.matrix.size
+
+
+def test_markov_chain_matrices_match_generate_matrix():
+
+    from subsurface import MarkovChain
+
+    reference = get_voronoi()
+
+    # Every proposal is accepted, so the chain drifts far enough to generate its base again
+    successful_voronoi,increment = MarkovChain(reference,40,0.0,0.02,rng=np.random.default_rng(2),progress_interval=None)
+
+    for voronoi in successful_voronoi:
+
+        expected = get_voronoi()
+        expected.seeds = voronoi.seeds
+
+        assert np.array_equal(voronoi.matrix,expected.generate_matrix().matrix)
+
+
+def test_generate_layer_matches_matrix():
+
+    from subsurface.tools import calculate_accuracy
+
+    voronoi = get_voronoi()
+
+    for layer in [0,5]:
+
+        layer_matrix = voronoi.generate_layer(layer)
+
+        assert layer_matrix.shape == tuple(voronoi.voxels[:2])
+        assert layer_matrix.dtype == voronoi.matrix.dtype
+        assert np.array_equal(layer_matrix,voronoi.matrix[:,:,layer])
+        assert calculate_accuracy(voronoi.matrix,layer_matrix,layer=layer) == 1.0
+
+
+def test_update_matrix_in_hdf5(tmp_path):
+
+    import h5py
+
+    voronoi = get_voronoi()
+    seeds = voronoi.seeds + 0.01
+
+    expected = get_voronoi()
+    expected.seeds = seeds
+
+    with h5py.File(tmp_path/'grid.h5','w') as file:
+
+        voronoi.generate_matrix(out=voronoi.allocate_matrix(file,'matrix'),
+                                margin=voronoi.allocate_matrix(file,'margin',margin=True),chunk_size=1000)
+        voronoi.update_matrix(voronoi.seeds,seeds,out=voronoi.allocate_matrix(file,'updated'),chunk_size=1000)
+
+        assert np.array_equal(file['updated'][()],expected.generate_matrix().matrix)
+
+
+def test_find_misorientation_matches_local_misorientation():
+
+    from subsurface import find_neighbour_grains
+    from subsurface._shuffle import find_misorientation, find_local_misorientation
+
+    voronoi = get_voronoi()
+    indptr,indices = find_neighbour_grains(voronoi.matrix)
+
+    rng = np.random.default_rng(2)
+    orientations = rng.normal(size=(len(voronoi.seeds),4))
+    orientations /= np.linalg.norm(orientations,axis=1,keepdims=True)
+
+    distribution = find_misorientation(orientations,indptr,indices,None,'cF')
+    local = [find_local_misorientation(orientations,indptr,indices,i,None,'cF') for i in range(len(orientations))]
+
+    assert len(distribution) == len(indices)
+    assert np.allclose(distribution,np.concatenate(local))
+
+
+def test_resume_from_incremental_checkpoints(tmp_path):
+
+    import pytest
+    from subsurface import Shuffle, MarkovChain, resume_shuffle, resume_markov_chain, find_neighbour_grains
+
+    def interrupt(metrics):
+        if metrics['iteration'] >= 60:
+            raise KeyboardInterrupt
+
+    voronoi = get_voronoi()
+
+    rng = np.random.default_rng(3)
+    orientations = rng.normal(size=(len(voronoi.seeds),4))
+    orientations *= np.sign(orientations[:,:1])/np.linalg.norm(orientations,axis=1,keepdims=True)
+
+    arguments = dict(minimize=True,output_frequency=7,return_full=True)
+
+    expected = Shuffle(voronoi.matrix,orientations,100,rng=np.random.default_rng(4),**arguments)
+
+    with pytest.raises(KeyboardInterrupt):
+        Shuffle(voronoi.matrix,orientations,100,rng=np.random.default_rng(4),callback=interrupt,report_frequency=1,
+                checkpoint=str(tmp_path/'shuffle.h5'),checkpoint_interval=0.0,**arguments)
+
+    resumed = resume_shuffle(str(tmp_path/'shuffle.h5'))
+
+    assert np.array_equal(resumed[0],expected[0])
+    assert resumed[1:] == expected[1:]
+
+    expected = MarkovChain(voronoi,100,0.5,0.005,rng=np.random.default_rng(5),progress_interval=None)
+
+    with pytest.raises(KeyboardInterrupt):
+        MarkovChain(voronoi,100,0.5,0.005,rng=np.random.default_rng(5),progress_interval=None,callback=interrupt,
+                    report_frequency=1,checkpoint=str(tmp_path/'chain.h5'),checkpoint_interval=0.0)
+
+    resumed = resume_markov_chain(str(tmp_path/'chain.h5'),progress_interval=None)
+
+    assert resumed[1] == expected[1]
+    assert np.array_equal([v.seeds for v in resumed[0]],[v.seeds for v in expected[0]])
+
+
+def test_find_neighbour_grains_matches_brute_force():
+
+    import itertools
+    import pytest
+    from subsurface import find_neighbour_grains
+
+    material = Voronoi([9,8,7],[1.0,1.0,1.0],np.random.default_rng(6).random((12,3))).matrix
+
+    for periodic,connectivity in itertools.product([False,True],[6,18,26]):
+
+        indptr,indices,counts = find_neighbour_grains(material,periodic=periodic,connectivity=connectivity,
+                                                      return_counts=True,n_grains=15)
+
+        # Visit every voxel and every neighbour direction
+        expected = {}
+
+        for voxel in itertools.product(*map(range,material.shape)):
+            for direction in itertools.product([-1,0,1],repeat=3):
+
+                if not 0 < np.count_nonzero(direction) <= {6:1,18:2,26:3}[connectivity]:
+                    continue
+
+                other = np.add(voxel,direction)
+
+                if periodic:
+                    other %= material.shape
+                elif np.any(other < 0) or np.any(other >= material.shape):
+                    continue
+
+                a,b = material[voxel],material[tuple(other)]
+
+                if a != b:
+                    expected[a,b] = expected.get((a,b),0) + (np.count_nonzero(direction) == 1)
+
+        assert len(indptr) == 16
+
+        for grain in range(15):
+            neighbours = indices[indptr[grain]:indptr[grain+1]]
+
+            assert neighbours.tolist() == sorted(b for a,b in expected if a == grain)
+            assert counts[indptr[grain]:indptr[grain+1]].tolist() == [expected[grain,b] for b in neighbours]
+
+    with pytest.raises(ValueError):
+        find_neighbour_grains(material,n_grains=int(material.max()))
+
+
+def test_run_chains_is_silent_and_checkpoints_every_chain(tmp_path,capfd):
+
+    from subsurface import MarkovChain, run_chains
+
+    voronoi = get_voronoi()
+
+    successful,chain_index,increment = run_chains(voronoi,2,20,0.5,0.005,processes=2,seed=7,
+                                                  checkpoint=str(tmp_path/'chain.h5'),checkpoint_interval=0.0)
+
+    assert capfd.readouterr().out == ''
+    assert voronoi._matrix is None and voronoi.margin is None
+
+    for index,stream in enumerate(np.random.SeedSequence(7).spawn(2)):
+
+        assert (tmp_path/f'chain-{index}.h5').exists()
+
+        expected,expected_increment = MarkovChain(get_voronoi(),20,0.5,0.005,rng=np.random.default_rng(stream),progress_interval=None)
+
+        assert [i for c,i in zip(chain_index,increment) if c == index] == expected_increment
+        assert all(np.array_equal(a.seeds,b.seeds) for a,b in zip([v for c,v in zip(chain_index,successful) if c == index],expected))
+
+
+def test_save_loads_in_damask(tmp_path):
+
+    import pytest
+
+    damask = pytest.importorskip('damask')
+    h5py = pytest.importorskip('h5py')
+
+    from subsurface import write_vti
+
+    voronoi = get_voronoi()
+
+    for compression_level in [1,None]:
+
+        voronoi.save(tmp_path/f'memory-{compression_level}',cell_data={'grain':np.arange(len(voronoi.seeds))*2.0},
+                     compression_level=compression_level)
+
+        grid = damask.GeomGrid.load(tmp_path/f'memory-{compression_level}.vti')
+
+        assert grid.material.dtype == np.int32
+        assert np.array_equal(grid.material,voronoi.matrix)
+        assert np.allclose(grid.size/grid.cells,voronoi.size/voronoi.voxels)
+        assert np.allclose(grid.initial_conditions['grain'],voronoi.matrix*2.0)
+
+    # Read a few planes at a time so the grid is written in several slabs
+    with h5py.File(tmp_path/'grid.h5','w') as file:
+
+        voronoi.generate_matrix(out=voronoi.allocate_matrix(file,'matrix'))
+        write_vti(tmp_path/'dataset',voronoi.matrix,voronoi.size,memory=3*int(np.prod(voronoi.voxels[:2])))
+
+        grid = damask.GeomGrid.load(tmp_path/'dataset.vti')
+
+        assert np.array_equal(grid.material,file['matrix'][()])
+        assert np.allclose(grid.size,voronoi.size)
+
+
+def test_ensemble_round_trip(tmp_path):
+
+    import pytest
+
+    pytest.importorskip('h5py')
+
+    from subsurface import Ensemble
+
+    members = [get_voronoi(seed=seed) for seed in range(4)]
+    orientations = np.random.default_rng(8).random((4,60,4))
+
+    with Ensemble(tmp_path/'ensemble.h5','w',chunk_bytes=1000) as ensemble:
+
+        ensemble.append(members[0],orientations[0],increment=3)
+        ensemble.extend(members[1:3],orientations[1:3],increment=[5,8],accuracy=[0.9,0.8])
+        ensemble.append(members[3],orientations[3],rate=0.5)
+
+    with Ensemble(tmp_path/'ensemble.h5','r') as ensemble:
+
+        assert len(ensemble) == 4
+
+        for index,voronoi in enumerate(members):
+            assert np.array_equal(ensemble.matrix(index),voronoi.matrix)
+            assert np.array_equal(ensemble.seeds(index),voronoi.seeds)
+            assert np.array_equal(ensemble.orientations(index),orientations[index])
+            assert np.array_equal(ensemble[index].matrix,voronoi.matrix)
+
+        metadata = ensemble.metadata()
+
+        assert np.array_equal(metadata['increment'],[3,5,8,np.nan],equal_nan=True)
+        assert np.array_equal(metadata['accuracy'],[np.nan,0.9,0.8,np.nan],equal_nan=True)
+        assert np.array_equal(metadata['rate'],[np.nan,np.nan,np.nan,0.5],equal_nan=True)
+        member = ensemble.metadata(1)
+
+        assert sorted(member) == ['accuracy','increment','rate']
+        assert member['increment'] == 5 and member['accuracy'] == 0.9 and np.isnan(member['rate'])
+
+
+def test_swap_log_matches_snapshots(tmp_path):
+
+    from subsurface import Shuffle, SwapLog, resume_shuffle
+
+    voronoi = get_voronoi()
+
+    rng = np.random.default_rng(9)
+    orientations = rng.normal(size=(len(voronoi.seeds),4))
+    orientations *= np.sign(orientations[:,:1])/np.linalg.norm(orientations,axis=1,keepdims=True)
+
+    for batch in [1,8]:
+
+        arguments = dict(minimize=True,batch=batch,keyframe_frequency=40)
+
+        snapshots = Shuffle(voronoi.matrix,orientations,200,rng=np.random.default_rng(10),**arguments)
+        log = Shuffle(voronoi.matrix,orientations,200,rng=np.random.default_rng(10),output='log',
+                      checkpoint=str(tmp_path/f'log-{batch}.h5'),**arguments)
+
+        assert len(log) > 0 and len(log.keyframe_step) > 2
+
+        # Steps on both sides of every keyframe
+        steps = sorted({s+d for s in log.keyframe_step for d in [-1,0,1] if 0 <= s+d < 200})
+
+        log.save(tmp_path/f'log-{batch}.npz')
+
+        for restored in [log,SwapLog.load(tmp_path/f'log-{batch}.npz'),resume_shuffle(str(tmp_path/f'log-{batch}.h5'))]:
+
+            assert np.array_equal(restored.pairs,log.pairs)
+
+            for s in steps:
+                assert np.array_equal(restored.orientations(s+1),snapshots[s])
+
+
+def get_network(seed=11,bins=None):
+
+    from subsurface import find_neighbour_grains
+    from subsurface._shuffle import MisorientationNetwork
+    from subsurface.misorientation import symmetry_operators
+
+    voronoi = get_voronoi()
+    indptr,indices,counts = find_neighbour_grains(voronoi.matrix,return_counts=True)
+
+    rng = np.random.default_rng(seed)
+    orientations = rng.normal(size=(len(voronoi.seeds),4))
+    orientations *= np.sign(orientations[:,:1])/np.linalg.norm(orientations,axis=1,keepdims=True)
+
+    return MisorientationNetwork(orientations,indptr,indices,symmetry_operators('cI'),bins=bins,counts=counts)
+
+
+def test_batched_swaps_match_sequential_swaps():
+
+    from subsurface._shuffle import choose_pairs, choose_independent_pairs, find_new_arrangement, find_new_arrangements
+
+    rng = np.random.default_rng(12)
+
+    for minimize in [True,False]:
+
+        batched = get_network(bins=np.linspace(0,65,14))
+        sequential = get_network(bins=np.linspace(0,65,14))
+
+        for _ in range(20):
+
+            pairs = choose_independent_pairs(batched.indptr,batched.indices,choose_pairs(np.arange(60),32,rng))
+
+            changes,accepted = find_new_arrangements(batched,pairs[:,0],pairs[:,1],minimize)
+
+            for (i,j),change,kept in zip(pairs,changes,accepted):
+
+                expected = find_new_arrangement(sequential,i,j,minimize)
+
+                assert np.isclose(change,expected)
+                assert kept == (expected < 0 or not minimize)
+
+            assert np.array_equal(batched.assignment,sequential.assignment)
+            assert np.allclose(batched.omega,sequential.omega)
+            assert np.isclose(batched.total,sequential.total)
+            assert np.allclose(batched.histogram,sequential.histogram)
+
+
+def test_disorientation_angle_matches_damask():
+
+    import pytest
+
+    damask = pytest.importorskip('damask')
+
+    from subsurface.misorientation import symmetry_operators, disorientation_angle, DisorientationTable
+
+    rng = np.random.default_rng(13)
+
+    for lattice in ['cI','cF','hP']:
+
+        a = damask.Rotation.from_random(50,rng_seed=rng.integers(2**31)).as_quaternion()
+        b = damask.Rotation.from_random(50,rng_seed=rng.integers(2**31)).as_quaternion()
+
+        expected = np.degrees(damask.Orientation.from_quaternion(q=a,lattice=lattice)
+                              .disorientation_angle(damask.Orientation.from_quaternion(q=b,lattice=lattice)))
+
+        operators = symmetry_operators(lattice)
+
+        assert np.allclose(disorientation_angle(a,b,operators),expected,atol=1e-6)
+
+        # Pairs between the first and the second half of the orientations, met twice and in both orders
+        orientations = np.concatenate([a,b])
+        first,second = np.arange(50),np.arange(50,100)
+
+        for dense_limit,maxsize in [(2048,2**22),(0,2**22),(0,20)]:
+
+            table = DisorientationTable(orientations,operators,dense_limit=dense_limit,maxsize=maxsize)
+
+            assert np.allclose(table(first,second),expected,atol=1e-6)
+            assert np.allclose(table(second[::-1],first[::-1]),expected[::-1],atol=1e-6)
+
+            # A small cache only keeps the pairs met last, which the reversed lookup meets first
+            assert table.misses == 50 + max(0,50-maxsize)
+            assert len(table._cache) == (0 if dense_limit else min(maxsize,50))
+
+
+def test_grain_centre_matches_per_grain_mean():
+
+    # Previous implementation, the mean voxel index of every grain and the seed for empty grains
+    voronoi = get_voronoi()
+    voronoi.seeds = np.concatenate([voronoi.seeds,[voronoi.seeds[0]]])
+
+    expected = []
+
+    for grain,seed in enumerate(voronoi.seeds):
+        position = np.argwhere(voronoi.matrix == grain)
+        expected.append(np.mean(position,axis=0)*voronoi.size/voronoi.voxels if len(position) else seed)
+
+    assert np.allclose(voronoi.grain_centre,expected)
+    assert np.array_equal(voronoi.grain_volume,[np.count_nonzero(voronoi.matrix == grain)*np.prod(voronoi.size/voronoi.voxels)
+                                                for grain in range(len(voronoi.seeds))])
+
+
+def test_periodic_grain_centre_wraps_around_the_faces():
+
+    voronoi = get_voronoi(periodic=True)
+
+    # A grain in the corner of the grid, split over all eight corners
+    voronoi.seeds = np.concatenate([voronoi.seeds,[voronoi.size*0.999]])
+    matrix = voronoi.matrix
+    grain = len(voronoi.seeds)-1
+
+    assert np.array_equal(voronoi.grain_bounds[grain],[[0,0,0],np.subtract(voronoi.voxels,1)])
+
+    for label in range(len(voronoi.seeds)):
+
+        # Place every voxel at its nearest image to the voxel of the seed
+        position = np.argwhere(matrix == label)
+        seed_voxel = voronoi.seeds[label]/voronoi.size*voronoi.voxels
+        position = position - np.round((position - seed_voxel)/voronoi.voxels)*voronoi.voxels
+
+        expected = np.mod(np.mean(position,axis=0),voronoi.voxels)*voronoi.size/voronoi.voxels
+
+        # Compare positions on the torus
+        difference = np.mod(voronoi.grain_centre[label] - expected + voronoi.size/2,voronoi.size) - voronoi.size/2
+
+        assert np.allclose(difference,0)
+
+
+def test_generate_clusters_matches_per_voxel_lookup():
+
+    import scipy.spatial
+
+    rng = np.random.default_rng(14)
+
+    for periodic in [False,True]:
+
+        size = np.array([1.0,0.8,0.6])
+        seeds = rng.random((60,3))*size
+        clusters = [rng.random((12,3))*size,rng.random((4,3))*size]
+
+        # Previous implementation, the nearest cluster of every voxel's label looked up voxel by voxel
+        def relabel(matrix,points,level):
+            lookup = dict(enumerate(scipy.spatial.KDTree(level,boxsize=size if periodic else None).query(points)[1]))
+            return np.vectorize(lambda x: lookup[x])(matrix)
+
+        finest = relabel(Voronoi([24,20,16],size,seeds,periodic=periodic).matrix,seeds,clusters[0])
+        expected = relabel(finest,clusters[0],clusters[1])
+
+        voronoi = Voronoi([24,20,16],size,seeds,clusters=clusters,periodic=periodic).generate_clusters()
+
+        assert np.array_equal(voronoi.matrix,expected)
+        assert np.array_equal(voronoi.cluster_matrix(0),finest)
+        assert np.array_equal(voronoi.seed_matrix,Voronoi([24,20,16],size,seeds,periodic=periodic).matrix)
+
+        # A single level of clusters
+        voronoi = Voronoi([24,20,16],size,seeds,clusters=clusters[0],periodic=periodic).generate_clusters()
+
+        assert np.array_equal(voronoi.matrix,finest)
+
+
+def test_incremental_energy_matches_recomputed_energy():
+
+    from subsurface._shuffle import (choose_pairs, choose_independent_pairs, find_new_arrangement, find_new_arrangements,
+                                     find_matched_arrangement, network_energy, histogram_error)
+
+    bins = np.linspace(0,65,14)
+    target = np.full(13,1/13)
+
+    network = get_network(bins=bins)
+    fresh = get_network(bins=bins)
+
+    rng = np.random.default_rng(15)
+    outcomes = []
+
+    for step in range(300):
+
+        i,j = choose_pairs(np.arange(60),1,rng)[0]
+
+        if step % 3 == 0:
+            outcomes.append(find_new_arrangement(network,i,j,True) < 0)
+        elif step % 3 == 1:
+            outcomes.append(find_matched_arrangement(network,i,j,target) < 0)
+        else:
+            pairs = choose_independent_pairs(network.indptr,network.indices,choose_pairs(np.arange(60),16,rng))
+            outcomes.extend(find_new_arrangements(network,pairs[:,0],pairs[:,1],True)[1])
+
+        # The same arrangement evaluated from scratch
+        fresh.assign(network.assignment)
+
+        assert np.allclose(network.omega,fresh.omega)
+        assert np.isclose(network_energy(network),network_energy(fresh))
+        assert np.allclose(network.histogram,fresh.histogram)
+        assert np.isclose(network_energy(network,target),histogram_error(fresh.histogram,target))
+
+    # Both accepted and rejected swaps were made
+    assert any(outcomes) and not all(outcomes)
+
+
+def test_iter_markov_chain_matches_markov_chain():
+
+    from subsurface import MarkovChain, iter_markov_chain
+
+    for output_frequency,surface_only in [(1,False),(3,False),(2,True)]:
+
+        arguments = dict(output_frequency=output_frequency,surface_only=surface_only,progress_interval=None)
+
+        expected,increments = MarkovChain(get_voronoi(),60,0.5,0.005,rng=np.random.default_rng(16),**arguments)
+        streamed = list(iter_markov_chain(get_voronoi(),60,0.5,0.005,rng=np.random.default_rng(16),**arguments))
+
+        assert len(expected) > 1
+        assert [N for N,_ in streamed] == increments[::output_frequency]
+
+        for (_,voronoi),reference in zip(streamed,expected):
+            assert np.array_equal(voronoi.seeds,reference.seeds)
+            assert np.array_equal(voronoi.matrix,reference.matrix)
+
+
+def test_tiled_generate_matrix_matches_single_tile():
+
+    for periodic,minkowski in [(False,2.0),(True,2.0),(True,1.0)]:
+
+        expected = get_voronoi(periodic,minkowski).generate_matrix(chunk_size=24*20*16,margin=True)
+
+        # Single rows, partial rows of a slab and several slabs, none of which divide the grid
+        for chunk_size,workers in [(16,1),(100,2),(2000,8)]:
+
+            voronoi = get_voronoi(periodic,minkowski).generate_matrix(chunk_size=chunk_size,workers=workers,margin=True)
+
+            assert np.array_equal(voronoi.matrix,expected.matrix)
+            assert np.array_equal(voronoi.margin,expected.margin)
+
+            voronoi = get_voronoi(periodic,minkowski).generate_matrix(chunk_size=chunk_size,workers=workers)
+
+            assert np.array_equal(voronoi.matrix,expected.matrix)
+
+        voronoi = get_voronoi(periodic,minkowski).generate_matrix(memory=64*700)
+
+        assert np.array_equal(voronoi.matrix,expected.matrix)
+
+
+def test_import_leaves_heavy_packages_unloaded():
+
+    import pathlib
+    import subprocess
+    import sys
+
+    code = ('import sys, subsurface; '
+            'print(sorted(name for name in ["matplotlib","damask","pandas","scienceplots"] if name in sys.modules))')
+
+    result = subprocess.run([sys.executable,'-c',code],capture_output=True,text=True,check=True,
+                            cwd=pathlib.Path(__file__).resolve().parents[1])
+
+    assert result.stdout.strip() == '[]'